@@ -0,0 +1,173 @@
+'''Cache of highlighted texts extracted from PDFs, kept across runs.
+
+
+# Copyright 2016 Guang-zhi XU
+#
+# This file is distributed under the terms of the
+# GPLv3 licence. See the LICENSE file for details.
+# You may use, distribute and modify this code under the
+# terms of the GPLv3 license.
+'''
+
+import os
+import sys
+import json
+import time
+import hashlib
+import sqlite3
+
+
+# Default size limit of the cache, in bytes of texts stored
+MAXSIZE=64*1024**2
+
+# Version of the cached texts, part of every key. Bump it whenever the
+# extraction gives different texts, or the stored values change shape,
+# so that entries of older versions are no longer used.
+CACHE_VERSION=3
+
+
+
+#----------------------Get user cache directory----------------------
+def getCacheDir():
+    '''Get the directory to save the cache to
+
+    ~/.cache/menotexport on Linux (or $XDG_CACHE_HOME/menotexport),
+    ~/Library/Caches/menotexport on Mac, %LOCALAPPDATA%\\menotexport on
+    Windows.
+    '''
+    if sys.platform.startswith('win'):
+        base=os.environ.get('LOCALAPPDATA',os.path.expanduser('~'))
+    elif sys.platform=='darwin':
+        base=os.path.expanduser('~/Library/Caches')
+    else:
+        base=os.environ.get('XDG_CACHE_HOME',os.path.expanduser('~/.cache'))
+
+    return os.path.join(base,'menotexport')
+
+
+
+#----------------Cache of extracted highlighted texts----------------
+class AnnoCache(object):
+
+    def __init__(self,path=None,maxsize=MAXSIZE,gethash=None):
+        '''Obj to hold extracted highlighted texts in an sqlite file.
+
+        <path>: str or None, path to the sqlite file. If None, save to
+                annocache.sqlite in getCacheDir().
+        <maxsize>: int, size limit (bytes of texts). Least recently used
+                   entries are dropped by evict() to keep below.
+        <gethash>: callable or None, documentId -> file hash (Files.hash).
+                   Not kept when the obj is pickled to worker processes.
+
+        Entries are keyed by (CACHE_VERSION, file hash, page, highlight
+        rects, backend), and hold the [text, rect] of each text box
+        extracted from a page, in order. Colors, creation times and
+        meta-data are not cached, they are taken from the database on each
+        run.
+
+        New entries and access times of cache hits are kept in memory, and
+        written in one transaction by flush() or close().
+        '''
+        if path is None:
+            path=os.path.join(getCacheDir(),'annocache.sqlite')
+        self.path=path
+        self.maxsize=maxsize
+        self.gethash=gethash
+        self._atimes={}
+        self._puts={}
+        self._connect()
+
+    def _connect(self):
+        basedir=os.path.dirname(self.path)
+        if basedir and not os.path.isdir(basedir):
+            os.makedirs(basedir)
+        self.db=sqlite3.connect(self.path,timeout=60,isolation_level=None)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS cache
+                (key TEXT PRIMARY KEY, texts TEXT, size INTEGER, atime REAL)''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS cache_atime
+                ON cache (atime)''')
+
+    def __getstate__(self):
+        return {'path': self.path, 'maxsize': self.maxsize}
+
+    def __setstate__(self,state):
+        self.path=state['path']
+        self.maxsize=state['maxsize']
+        self.gethash=None
+        self._atimes={}
+        self._puts={}
+        self._connect()
+
+    def getKey(self,filehash,page,highlights,backend):
+        '''Get the key of highlights in a page
+
+        <filehash>: str, Files.hash of the PDF.
+        <page>: int, page number.
+        <highlights>: list, highlight dicts in <page>, see getHighlights().
+                      Get the key before the rects are merged by mergeLine().
+        <backend>: str, name of the text extraction method.
+        '''
+        rects=sorted([[float(jj) for jj in ii['rect']] for ii in highlights])
+        key=json.dumps([CACHE_VERSION,filehash,page,rects,backend])
+        return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+    def get(self,key):
+        '''Get cached texts of a key, None if not cached'''
+        if key in self._puts:
+            return json.loads(self._puts[key][0])
+        row=self.db.execute('SELECT texts FROM cache WHERE key=?',\
+                (key,)).fetchone()
+        if row is None:
+            return None
+        self._atimes[key]=time.time()
+        return json.loads(row[0])
+
+    def flush(self):
+        '''Write new entries and access times of cache hits'''
+        if len(self._atimes)==0 and len(self._puts)==0:
+            return
+        self.db.execute('BEGIN')
+        try:
+            self.db.executemany('INSERT OR REPLACE INTO cache VALUES (?,?,?,?)',\
+                    [(kk,)+vv for kk,vv in self._puts.items()])
+            self.db.executemany('UPDATE cache SET atime=? WHERE key=?',\
+                    [(vv,kk) for kk,vv in self._atimes.items()])
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+        self._atimes={}
+        self._puts={}
+
+    def put(self,key,texts):
+        '''Cache texts of a key, written by flush()'''
+        texts=json.dumps(texts)
+        self._puts[key]=(texts,len(texts),time.time())
+
+    def clear(self):
+        '''Drop all entries'''
+        self._atimes={}
+        self._puts={}
+        self.db.execute('DELETE FROM cache')
+        self.db.execute('VACUUM')
+
+    def evict(self):
+        '''Drop least recently used entries to keep below <maxsize>'''
+        total=self.db.execute('SELECT SUM(size) FROM cache').fetchone()[0]
+        if total is None or total<=self.maxsize:
+            return
+
+        keys=[]
+        rows=self.db.execute('SELECT key,size FROM cache ORDER BY atime')
+        for key,size in rows.fetchall():
+            if total<=self.maxsize:
+                break
+            keys.append((key,))
+            total-=size
+        self.db.executemany('DELETE FROM cache WHERE key=?',keys)
+
+    def close(self):
+        self.flush()
+        self.evict()
+        self.db.close()
+
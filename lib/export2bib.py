@@ -183,15 +183,26 @@ def parseMeta(metadict,basedir,isfile,iszotero,verbose=True):
 
 
 #--------------Export documents with annotations to .bib--------------
-def exportAnno2Bib(annodict,basedir,outdir,allfolders,isfile,iszotero,verbose=True):
+def exportAnno2Bib(annodict,basedir,outdir,allfolders,isfile,iszotero,verbose=True,\
+        outfiles=None):
     '''Export documents with annotations to .bib
 
     annolist,outdir
     '''
 
-    #----------------Loop through docs----------------
-    doclist=[]
+    #----------------------Export----------------------
+    faillist=exportDoc2Bib(iterAnnoDocs(annodict),basedir,outdir,\
+            allfolders,isfile,iszotero,verbose,outfiles)
+
+    return faillist
+
 
+
+def iterAnnoDocs(annodict):
+    '''Yield meta-data dicts of documents, with highlights and notes as 'annote'
+    '''
+
+    #----------------Loop through docs----------------
     for idii,annoii in annodict.items():
         metaii=annoii.meta
         hlii=annoii.highlights
@@ -209,24 +220,22 @@ def exportAnno2Bib(annodict,basedir,outdir,allfolders,isfile,iszotero,verbose=Tr
                 annotexts.append('- %s' %ntjj.text)
 
         metaii['annote']=annotexts
-        doclist.append(metaii)
-
-    #----------------------Export----------------------
-    faillist=exportDoc2Bib(doclist,basedir,outdir,\
-            allfolders,isfile,iszotero,verbose)
-
-    return faillist
+        yield metaii
 
     
 
 
 
-
 #-------------Export documents without annotations to .bib-------------
-def exportDoc2Bib(doclist,basedir,outdir,allfolders,isfile,iszotero,verbose=True):
+def exportDoc2Bib(doclist,basedir,outdir,allfolders,isfile,iszotero,verbose=True,\
+        outfiles=None):
     '''Export documents without annotations to .bib
 
     doclist,outdir
+    <doclist>: iterable of meta-data dicts, e.g. a generator.
+    <outfiles>: OutputFiles obj or None. If given, entries are written to
+                its writer of the output file, which stays open for the
+                whole run. Otherwise they are appended to the output file.
     '''
 
     if allfolders:
@@ -237,15 +246,22 @@ def exportDoc2Bib(doclist,basedir,outdir,allfolders,isfile,iszotero,verbose=True
 
     abpath_out=os.path.join(outdir,fileout)
 
-    #----------------Loop through docs----------------
+    #----------------Write entries one by one----------------
     faillist=[]
+    entries=iterBib(doclist,basedir,isfile,iszotero)
 
-    for docii in doclist:
-        bibdata=parseMeta(docii,basedir,isfile,iszotero)
+    if outfiles is not None:
+        outfiles.writelines(abpath_out,entries)
+    else:
         with open(abpath_out, mode='a') as fout:
-            fout.write(bibdata)
-        #faillist.append(docii['title'])
+            fout.writelines(entries)
 
     return faillist
 
 
+
+def iterBib(doclist,basedir,isfile,iszotero):
+    '''Yield the .bib entry of each document
+    '''
+    for docii in doclist:
+        yield parseMeta(docii,basedir,isfile,iszotero)
@@ -231,14 +231,25 @@ def parseMeta(metadict,basedir,isfile,iszotero,verbose=True):
 
 
 #--------------Export documents with annotations to .ris--------------
-def exportAnno2Ris(annodict,basedir,outdir,allfolders,isfile,iszotero,verbose=True):
+def exportAnno2Ris(annodict,basedir,outdir,allfolders,isfile,iszotero,verbose=True,\
+        outfiles=None):
     '''Export documents with annotations to .ris
 
     '''
 
-    #----------------Loop through docs----------------
-    doclist=[]
+    #----------------------Export----------------------
+    faillist=exportDoc2Ris(iterAnnoDocs(annodict),basedir,outdir,\
+            allfolders,isfile,iszotero,verbose,outfiles)
+
+    return faillist
+
 
+
+def iterAnnoDocs(annodict):
+    '''Yield meta-data dicts of documents, with highlights and notes as 'annote'
+    '''
+
+    #----------------Loop through docs----------------
     for idii,annoii in annodict.items():
         metaii=annoii.meta
         hlii=annoii.highlights
@@ -256,20 +267,21 @@ def exportAnno2Ris(annodict,basedir,outdir,allfolders,isfile,iszotero,verbose=Tr
                 annotexts.append('- %s' %ntjj.text)
 
         metaii['annote']=annotexts
-        doclist.append(metaii)
+        yield metaii
 
-    #----------------------Export----------------------
-    faillist=exportDoc2Ris(doclist,basedir,outdir,\
-            allfolders,isfile,iszotero,verbose)
+    
 
-    return faillist
 
-    
 
 #-------------Export documents without annotations to .ris-------------
-def exportDoc2Ris(doclist,basedir,outdir,allfolders,isfile,iszotero,verbose=True):
+def exportDoc2Ris(doclist,basedir,outdir,allfolders,isfile,iszotero,verbose=True,\
+        outfiles=None):
     '''Export documents without annotations to .bib
 
+    <doclist>: iterable of meta-data dicts, e.g. a generator.
+    <outfiles>: OutputFiles obj or None. If given, entries are written to
+                its writer of the output file, which stays open for the
+                whole run. Otherwise they are appended to the output file.
     '''
 
     if allfolders:
@@ -280,15 +292,22 @@ def exportDoc2Ris(doclist,basedir,outdir,allfolders,isfile,iszotero,verbose=True
 
     abpath_out=os.path.join(outdir,fileout)
 
-    #----------------Loop through docs----------------
+    #----------------Write entries one by one----------------
     faillist=[]
+    entries=iterRis(doclist,basedir,isfile,iszotero)
 
-    for docii in doclist:
-        risdata=parseMeta(docii,basedir,isfile,iszotero)
+    if outfiles is not None:
+        outfiles.writelines(abpath_out,entries)
+    else:
         with open(abpath_out, mode='a') as fout:
-            fout.write(risdata)
-        #faillist.append(docii['title'])
+            fout.writelines(entries)
 
     return faillist
 
 
+
+def iterRis(doclist,basedir,isfile,iszotero):
+    '''Yield the .ris entry of each document
+    '''
+    for docii in doclist:
+        yield parseMeta(docii,basedir,isfile,iszotero)
@@ -0,0 +1,344 @@
+'''Export highlights and notes from documents in Mendeley to data tables.
+
+One row per highlight or note, with the columns in FIELDS. Rows are
+written by a backend chosen by its format name, see WRITERS:
+
+    jsonl:   JSON Lines text file, one JSON object per row.
+    parquet: Apache Parquet file, requires pyarrow.
+    arrow:   Apache Arrow IPC file, requires pyarrow.
+
+Other backends can be added with registerWriter().
+
+
+# Copyright 2016 Guang-zhi XU
+#
+# This file is distributed under the terms of the
+# GPLv3 licence. See the LICENSE file for details.
+# You may use, distribute and modify this code under the
+# terms of the GPLv3 license.
+'''
+
+import os
+import json
+import tempfile
+from datetime import datetime
+
+
+# Columns of a row
+FIELDS=['docid','citationkey','kind','page','rect','color','ctime',\
+        'text','tags']
+
+# Number of rows written at a time by the columnar backends
+BATCHSIZE=10000
+
+
+
+#------------------------Rows of annotations------------------------
+def getTags(anno):
+    '''Get the tags of an Anno obj as a list of str
+    '''
+    tags=anno.tags
+    # Anno obj stores 'None' if the document has no tags
+    if tags is None or tags=='None':
+        return []
+    if type(tags) is not list:
+        return [tags,]
+    return tags
+
+
+def iterRows(annodict):
+    '''Yield a row dict for each highlight and note
+
+    <annodict>: dict, keys: documentId; values: FileAnno objs, with
+                extracted highlights and notes.
+
+    Side-bar notes of documents have no position or creation time in
+    Mendeley, their rect and ctime are None.
+    '''
+
+    #----------------Loop through docs----------------
+    for idii,annoii in annodict.items():
+        for kindjj,annosjj in [('highlight',annoii.highlights),\
+                ('note',annoii.notes)]:
+            for ajj in annosjj or []:
+                yield {'docid': idii,\
+                       'citationkey': ajj.citationkey,\
+                       'kind': kindjj,\
+                       'page': ajj.page,\
+                       'rect': ajj.rect,\
+                       'color': ajj.color,\
+                       'ctime': None if ajj.sidebar else ajj.ctime,\
+                       'text': ajj.text,\
+                       'tags': getTags(ajj)}
+
+
+
+
+#-------------------------Row writers-------------------------
+class RowWriter(object):
+
+    # File name extension of the backend
+    ext=None
+
+    def __init__(self,path,outfiles=None):
+        '''Base class of backends writing rows to a single file
+
+        <path>: str, path to the output file.
+        <outfiles>: OutputFiles obj or None, buffered writers of output
+                    text files of the run.
+
+        Abstract, subclasses implement write(), and close() and abort()
+        if they hold the output file themselves.
+        '''
+        self.path=path
+        self.outfiles=outfiles
+
+    def write(self,rows):
+        '''Write rows from an iterable, e.g. a generator
+
+        Abstract, to be implemented by subclasses.
+        '''
+        raise NotImplementedError('%s.write()' %type(self).__name__)
+
+    def close(self):
+        '''Finish the output file'''
+        pass
+
+    def abort(self):
+        '''Drop the output file, leaving <path> untouched'''
+        pass
+
+
+
+def _jsonDefault(obj):
+    if isinstance(obj,datetime):
+        return obj.strftime('%Y-%m-%dT%H:%M:%SZ')
+    raise TypeError(repr(obj))
+
+
+class JsonlWriter(RowWriter):
+    '''Write rows as JSON Lines, one JSON object per line
+
+    Lines are written through the OutputFiles of the run, so the file is
+    replaced only when the OutputFiles obj is closed.
+    '''
+
+    ext='.jsonl'
+
+    def __init__(self,path,outfiles=None):
+        if outfiles is None:
+            from outputfiles import OutputFiles
+            outfiles=OutputFiles()
+            self._ownfiles=True
+        else:
+            self._ownfiles=False
+        RowWriter.__init__(self,path,outfiles)
+
+    def iterLines(self,rows):
+        for rowii in rows:
+            yield json.dumps(rowii,default=_jsonDefault,sort_keys=True)+'\n'
+
+    def write(self,rows):
+        self.outfiles.writelines(self.path,self.iterLines(rows))
+
+    def close(self):
+        if self._ownfiles:
+            self.outfiles.close()
+
+    def abort(self):
+        if self._ownfiles:
+            self.outfiles.abort()
+
+
+
+def importArrow():
+    '''Import pyarrow, an optional dependency of the columnar backends
+    '''
+    try:
+        import pyarrow
+    except ImportError:
+        raise Exception('pyarrow is required to export to .parquet or .arrow files.')
+    return pyarrow
+
+
+def getSchema(pa):
+    '''Get the arrow schema of rows'''
+    return pa.schema([('docid',pa.int64()),\
+            ('citationkey',pa.string()),\
+            ('kind',pa.string()),\
+            ('page',pa.int32()),\
+            ('rect',pa.list_(pa.float64())),\
+            ('color',pa.string()),\
+            ('ctime',pa.timestamp('s')),\
+            ('text',pa.string()),\
+            ('tags',pa.list_(pa.string()))])
+
+
+class ArrowWriter(RowWriter):
+    '''Write rows to an Arrow IPC file, in record batches of BATCHSIZE rows
+
+    The file is written as a temp file in the same folder, and renamed
+    to <path> by close().
+    '''
+
+    ext='.arrow'
+
+    def __init__(self,path,outfiles=None,batchsize=BATCHSIZE):
+        RowWriter.__init__(self,path,outfiles)
+        self.pa=importArrow()
+        self.schema=getSchema(self.pa)
+        self.batchsize=batchsize
+        self.rows=[]
+
+        folder,filename=os.path.split(os.path.abspath(path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        fd,self.tmpname=tempfile.mkstemp(prefix='.%s.' %filename,\
+                suffix='.tmp',dir=folder)
+        os.close(fd)
+        self.writer=self.open(self.tmpname)
+
+    def open(self,path):
+        self.sink=self.pa.OSFile(path,'wb')
+        return self.pa.RecordBatchFileWriter(self.sink,self.schema)
+
+    def writeBatch(self,batch):
+        self.writer.write_batch(batch)
+
+    def flush(self):
+        if len(self.rows)==0:
+            return
+        arrays=[self.pa.array([rowii[kk] for rowii in self.rows],\
+                type=self.schema.field(kk).type) for kk in FIELDS]
+        self.writeBatch(self.pa.RecordBatch.from_arrays(arrays,\
+                schema=self.schema))
+        self.rows=[]
+
+    def write(self,rows):
+        for rowii in rows:
+            self.rows.append(rowii)
+            if len(self.rows)>=self.batchsize:
+                self.flush()
+
+    def finish(self):
+        self.writer.close()
+        self.sink.close()
+
+    def close(self):
+        self.flush()
+        self.finish()
+        umask=os.umask(0)
+        os.umask(umask)
+        os.chmod(self.tmpname,0o666 & ~umask)
+        if os.name=='nt' and os.path.isfile(self.path):
+            os.remove(self.path)
+        os.rename(self.tmpname,self.path)
+
+    def abort(self):
+        self.rows=[]
+        try:
+            self.finish()
+        finally:
+            if os.path.exists(self.tmpname):
+                os.remove(self.tmpname)
+
+
+
+class ParquetWriter(ArrowWriter):
+    '''Write rows to a Parquet file, one row group per BATCHSIZE rows
+    '''
+
+    ext='.parquet'
+
+    def open(self,path):
+        import pyarrow.parquet
+        self.sink=None
+        return pyarrow.parquet.ParquetWriter(path,self.schema)
+
+    def writeBatch(self,batch):
+        self.writer.write_table(self.pa.Table.from_batches([batch,]))
+
+    def finish(self):
+        self.writer.close()
+
+
+
+# keys: format names, values: RowWriter subclasses
+WRITERS={'jsonl': JsonlWriter,\
+         'arrow': ArrowWriter,\
+         'parquet': ParquetWriter}
+
+
+def registerWriter(fmt,cls):
+    '''Add a backend
+
+    <fmt>: str, format name.
+    <cls>: RowWriter subclass, constructed with (path, outfiles).
+    '''
+    WRITERS[fmt]=cls
+
+
+
+
+#-------------------------Tables of the run-------------------------
+class TableFiles(object):
+
+    def __init__(self,fmt,outfiles=None):
+        '''Obj to hold one row writer per output table for a whole run
+
+        <fmt>: str, format name in WRITERS.
+        <outfiles>: OutputFiles obj or None, buffered writers of output
+                    text files of the run.
+
+        A table is opened at its first write(), and stays open for rows
+        of later folders written to the same path. close() finishes all
+        tables, and abort() drops them instead.
+        '''
+        if fmt not in WRITERS:
+            raise Exception('Unknown table format: %s' %fmt)
+        self.fmt=fmt
+        self.cls=WRITERS[fmt]
+        self.ext=self.cls.ext
+        self.outfiles=outfiles
+        self.writers={}
+
+    def write(self,path,rows):
+        path=os.path.abspath(path)
+        writer=self.writers.get(path)
+        if writer is None:
+            writer=self.cls(path,self.outfiles)
+            self.writers[path]=writer
+        writer.write(rows)
+
+    def close(self):
+        for writerii in self.writers.values():
+            writerii.close()
+        self.writers={}
+
+    def abort(self):
+        for writerii in self.writers.values():
+            writerii.abort()
+        self.writers={}
+
+
+
+
+#----------------Export annotations to a data table----------------
+def exportAnno2Table(annodict,outdir,allfolders,tables,verbose=True):
+    '''Export highlights and notes to a data table
+
+    <annodict>: dict, keys: documentId; values: FileAnno objs.
+    <outdir>: str, folder to save the table.
+    <allfolders>: bool, if True, the table of all folders is named
+                  Mendeley_annotations, otherwise after the folder.
+    <tables>: TableFiles obj, writers of the run.
+    '''
+
+    if allfolders:
+        fileout='Mendeley_annotations%s' %tables.ext
+    else:
+        folder=os.path.split(outdir)[-1]
+        fileout='Mendeley_annotations_%s%s' %(folder,tables.ext)
+
+    abpath_out=os.path.join(outdir,fileout)
+    tables.write(abpath_out,iterRows(annodict))
@@ -12,13 +12,19 @@ Update time: 2016-04-12 22:09:38.
 '''
 
 import os
-from textwrap import TextWrapper
 import tools
-from tools import printHeader, printInd, printNumHeader
+from tools import printHeader, printInd, printNumHeader, FastTextWrapper
+import outputfiles
+
+
+# Wrappers of highlight and note texts, and of tags. Reused for all
+# annotations, configured once.
+_wrapper=FastTextWrapper(width=80,initial_indent='',subsequent_indent='\t')
+_wrapper2=FastTextWrapper(width=80-7,initial_indent='',subsequent_indent='\t\t')
 
 
 #------------------Export annotations in a single PDF------------------
-def _exportAnnoFile(abpath_out,anno,verbose=True):
+def _exportAnnoFile(abpath_out,anno,verbose=True,outfiles=None):
     '''Export annotations in a single PDF
 
     <abpath_out>: str, absolute path to output txt file.
@@ -59,22 +65,18 @@ def _exportAnnoFile(abpath_out,anno,verbose=True):
 
     Use tabs in indention, and markup syntax: ">" for highlights, and "-" for notes.
 
+    <outfiles>: OutputFiles obj or None. If given, append to its writer of
+                <abpath_out>, which stays open for other PDFs. Otherwise
+                open <abpath_out> to append.
+
+    All texts of the PDF are written at once.
+
     Update time: 2016-02-24 13:59:56.
     '''
 
     conv=lambda x:unicode(x)
-
-    wrapper=TextWrapper()
-    wrapper.width=80
-    wrapper.initial_indent=''
-    #wrapper.subsequent_indent='\t'+int(len('> '))*' '
-    wrapper.subsequent_indent='\t'
-
-    wrapper2=TextWrapper()
-    wrapper2.width=80-7
-    wrapper2.initial_indent=''
-    #wrapper2.subsequent_indent='\t\t'+int(len('- Tags: '))*' '
-    wrapper2.subsequent_indent='\t\t'
+    wrapper=_wrapper
+    wrapper2=_wrapper2
 
     hlii=anno.highlights
     ntii=anno.notes
@@ -84,54 +86,49 @@ def _exportAnnoFile(abpath_out,anno,verbose=True):
     except:
         titleii=ntii[0].title
 
-    outstr=u'\n\n{0}\n# {1}'.format(int(80)*'-',conv(titleii))
-
-    with open(abpath_out, mode='a') as fout:
-        #outstr=outstr.encode('ascii','replace')
-        outstr=outstr.encode('utf8','replace')
-        fout.write(outstr)
+    outstr=[u'\n\n{0}\n# {1}'.format(int(80)*'-',conv(titleii)),]
 
-        #-----------------Write highlights-----------------
-        if len(hlii)>0:
+    #-----------------Write highlights-----------------
+    if len(hlii)>0:
 
-            #-------------Loop through highlights-------------
-            for hljj in hlii:
-                hlstr=wrapper.fill(hljj.text)
-                tagstr=', '.join(['@'+kk for kk in hljj.tags])
-                tagstr=wrapper2.fill(tagstr)
-                outstr=u'''
+        #-------------Loop through highlights-------------
+        for hljj in hlii:
+            hlstr=wrapper.fill(hljj.text)
+            tagstr=', '.join(['@'+kk for kk in hljj.tags])
+            tagstr=wrapper2.fill(tagstr)
+            outstr.append(u'''
 \n\t> {0}
 
 \t\t- @{1}
 \t\t- Tags: {2}
 \t\t- Ctime: {3}
 '''.format(*map(conv,[hlstr, hljj.citationkey,\
-    tagstr, hljj.ctime]))
+    tagstr, hljj.ctime])))
 
-                #outstr=outstr.encode('ascii','replace')
-                outstr=outstr.encode('utf8','replace')
-                fout.write(outstr)
+    #-----------------Write notes-----------------
+    if len(ntii)>0:
 
-        #-----------------Write notes-----------------
-        if len(ntii)>0:
-
-            #----------------Loop through notes----------------
-            for ntjj in ntii:
-                ntstr=wrapper.fill(ntjj.text)
-                tagstr=', '.join(['@'+kk for kk in ntjj.tags])
-                tagstr=wrapper2.fill(tagstr)
-                outstr=u'''
+        #----------------Loop through notes----------------
+        for ntjj in ntii:
+            ntstr=wrapper.fill(ntjj.text)
+            tagstr=', '.join(['@'+kk for kk in ntjj.tags])
+            tagstr=wrapper2.fill(tagstr)
+            outstr.append(u'''
 \n\t- {0}
 
 \t\t- @{1}
 \t\t- Tags: {2}
 \t\t- Ctime: {3}
 '''.format(*map(conv,[ntstr, ntjj.citationkey,\
-    tagstr, ntjj.ctime]))
+    tagstr, ntjj.ctime])))
 
-                #outstr=outstr.encode('ascii','replace')
-                outstr=outstr.encode('utf8','replace')
-                fout.write(outstr)
+    #outstr=outstr.encode('ascii','replace')
+    outstr=u''.join(outstr).encode('utf8','replace')
+    if outfiles is not None:
+        outfiles.write(abpath_out,outstr,atomic=False)
+    else:
+        with open(abpath_out, mode='a') as fout:
+            fout.write(outstr)
 
         
 
@@ -139,7 +136,7 @@ def _exportAnnoFile(abpath_out,anno,verbose=True):
 
     
 #--------------------Export highlights and/or notes--------------------
-def exportAnno(annodict,outdir,action,separate,verbose=True):
+def exportAnno(annodict,outdir,action,separate,verbose=True,outfiles=None):
     '''Export highlights and/or notes to txt file
 
     <annodict>: dict, keys: PDF file paths,
@@ -149,6 +146,9 @@ def exportAnno(annodict,outdir,action,separate,verbose=True):
     <action>: list, actions from cli arguments.
     <separate>: bool, True: save annotations if each PDF separately.
                       False: save annotations from all PDFs to a single file.
+    <outfiles>: OutputFiles obj or None, writers of output files kept open
+                for the whole run. If None, output files are closed on
+                return.
 
     Calls _exportAnnoFile() for core processes.
     '''
@@ -172,6 +172,10 @@ def exportAnno(annodict,outdir,action,separate,verbose=True):
 
     #----------------Loop through files----------------
     annofaillist=[]
+    if outfiles is None:
+        files=outputfiles.OutputFiles()
+    else:
+        files=outfiles
 
     num=len(annodict)
     docids=annodict.keys()
@@ -204,11 +208,14 @@ def exportAnno(annodict,outdir,action,separate,verbose=True):
 
         #----------------------Export----------------------
         try:
-            _exportAnnoFile(abpath_out,annoii)
+            _exportAnnoFile(abpath_out,annoii,verbose,files)
         except:
             annofaillist.append(basenameii)
             continue
 
+    if outfiles is None:
+        files.close()
+
     return annofaillist
 
 
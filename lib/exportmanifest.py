@@ -0,0 +1,131 @@
+'''Record exported PDFs, to skip unchanged ones in the next run.
+
+
+# Copyright 2016 Guang-zhi XU
+#
+# This file is distributed under the terms of the
+# GPLv3 licence. See the LICENSE file for details.
+# You may use, distribute and modify this code under the
+# terms of the GPLv3 license.
+'''
+
+import os
+import json
+import hashlib
+import tempfile
+
+
+
+#---------------Manifest of exported PDFs in an output folder---------------
+class ExportManifest(object):
+
+    filename='.menotexport_manifest.json'
+
+    def __init__(self,outdir,gethash):
+        '''Obj to record the inputs and outputs of exported PDFs.
+
+        <outdir>: str, the output directory. The manifest is saved as
+                  <outdir>/.menotexport_manifest.json, and outputs are
+                  recorded by their paths relative to <outdir>.
+        <gethash>: callable, documentId -> file hash (Files.hash).
+
+        Each output records a key of its inputs: file hash, and a hash of
+        the highlights and notes written to it; together with the mtime
+        and size of the output. An output is
+        up to date if its key is unchanged and the output file is still
+        the one written last time.
+        '''
+
+        self.outdir=os.path.abspath(outdir)
+        self.gethash=gethash
+        self.path=os.path.join(self.outdir,self.filename)
+        self.entries={}
+
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path,'r') as fin:
+                    self.entries=json.load(fin)
+            except:
+                self.entries={}
+
+    def _relPath(self,outpath):
+        return os.path.relpath(os.path.abspath(outpath),self.outdir)
+
+    def annoKey(self,anno):
+        '''Get the input key of a FileAnno obj
+        '''
+        return [self.gethash(anno.docid),self.annoHash(anno)]
+
+    def annoHash(self,anno):
+        '''Get a hash of the highlights and notes of a FileAnno obj
+
+        Highlights are hashed by page, rect, color and creation time,
+        notes by page, rect, author and content. Creation time of notes
+        is left out, as side-bar notes get the time of the run.
+        '''
+        rows=[]
+        for pp,hlpp in sorted((anno.highlights or {}).items()):
+            for hii in hlpp:
+                rows.append(['h',pp,hii['rect'],hii['color'],\
+                        hii['cdate'].isoformat()])
+        for pp,ntpp in sorted((anno.notes or {}).items()):
+            for nii in ntpp:
+                rows.append(['n',pp,nii['rect'],nii['author'],\
+                        nii['content']])
+        if len(rows)==0:
+            return None
+        rows=json.dumps(rows,sort_keys=True)
+        return hashlib.sha1(rows.encode('utf8')).hexdigest()
+
+    def docKey(self,doc):
+        '''Get the input key of an un-annotated doc, given its meta-data dict
+        '''
+        return [self.gethash(doc['docid']),None]
+
+    def isCurrent(self,outpath,key):
+        '''Check if an output is up to date with its inputs
+
+        <outpath>: str, path to the output file.
+        <key>: list, input key from annoKey() or docKey().
+        '''
+        entry=self.entries.get(self._relPath(outpath))
+        if entry is None or entry['key']!=key:
+            return False
+        try:
+            stat=os.stat(outpath)
+        except OSError:
+            return False
+        return entry['mtime']==stat.st_mtime and entry['size']==stat.st_size
+
+    def update(self,outpath,key):
+        '''Record an output after it is written
+
+        If <outpath> doesn't exist, forget it.
+        '''
+        relpath=self._relPath(outpath)
+        try:
+            stat=os.stat(outpath)
+        except OSError:
+            self.entries.pop(relpath,None)
+            return
+        self.entries[relpath]={'key': key, 'mtime': stat.st_mtime,\
+                'size': stat.st_size}
+
+    def save(self):
+        '''Write the manifest to <outdir>, via a temp file and rename
+        '''
+        if not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+        fd,tmpname=tempfile.mkstemp(prefix=self.filename+'.',\
+                suffix='.tmp',dir=self.outdir)
+        try:
+            with os.fdopen(fd,'w') as fout:
+                json.dump(self.entries,fout)
+            if os.name=='nt' and os.path.isfile(self.path):
+                os.remove(self.path)
+            os.rename(tmpname,self.path)
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
@@ -12,7 +12,12 @@ Update time: 2016-04-12 22:09:38.
 '''
 
 import os
+import copy
+import time
 import shutil
+import tempfile
+import collections
+import multiprocessing
 import PyPDF2
 import pdfannotation
 from tools import printHeader, printInd, printNumHeader
@@ -20,13 +25,84 @@ from tools import printHeader, printInd, printNumHeader
 
 
 #--------------------Export PDFs with annotations--------------
-def exportAnnoPdf(annotations,outdir,verbose=True):
+def exportAnnoPdf(annotations,outdir,verbose=True,jobs=1,manifest=None,\
+        pool=None):
     '''Export PDFs
+
+    <annotations>: dict, keys: documentId; values: FileAnno objs.
+    <outdir>: string, absolute path to the output directory.
+    <jobs>: int, number of worker processes. If > 1, PDFs are exported
+            in a process pool, with at most 2*<jobs> PDFs in flight.
+    <manifest>: ExportManifest obj or None. If given, skip PDFs whose
+                inputs and output are unchanged since the last export,
+                and record the exported ones.
+    <pool>: multiprocessing.Pool obj or None, pool of the run to use if
+            <jobs> > 1. If None, a pool is created for the call.
+
+    Return <faillist>: list, file names of PDFs failed to export, in the
+                       order of <annotations> regardless of <jobs>.
     '''
 
     faillist=[]
-    num=len(annotations)
-    for ii,idii in enumerate(annotations.keys()):
+    docids=annotations.keys()
+
+    #-----------Skip PDFs unchanged since last export-----------
+    keys={}
+    if manifest is not None:
+        for idii in annotations.keys():
+            annoii=annotations[idii]
+            keys[idii]=manifest.annoKey(annoii)
+            if manifest.isCurrent(os.path.join(outdir,annoii.filename),\
+                    keys[idii]):
+                docids.remove(idii)
+        if verbose and len(docids)<len(annotations):
+            printInd('Skip %d unchanged PDFs.'\
+                    %(len(annotations)-len(docids)),4)
+
+    num=len(docids)
+
+    if jobs>1 and num>1:
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+
+        ownpool=pool is None
+        if ownpool:
+            pool=multiprocessing.Pool(min(jobs,num),maxtasksperchild=50)
+        pending=collections.deque()
+
+        def collect():
+            ii,idii,result=pending.popleft()
+            fnameii=annotations[idii].filename
+            if verbose:
+                printNumHeader('Exporting PDF:',ii+1,num,3)
+                printInd(fnameii,4)
+            if not result.get():
+                faillist.append(fnameii)
+            elif manifest is not None:
+                manifest.update(os.path.join(outdir,fnameii),keys[idii])
+
+        try:
+            for ii,idii in enumerate(docids):
+                annoii=annotations[idii]
+
+                # Only page annotations are needed to write the PDF
+                jobii=copy.copy(annoii)
+                jobii.meta=None
+
+                pending.append((ii,idii,pool.apply_async(\
+                        _exportPdfJob,(annoii.path,outdir,jobii))))
+                if len(pending)>=2*jobs:
+                    collect()
+            while pending:
+                collect()
+        finally:
+            if ownpool:
+                pool.close()
+                pool.join()
+
+        return faillist
+
+    for ii,idii in enumerate(docids):
         annoii=annotations[idii]
         fii=annoii.path
         fnameii=annoii.filename
@@ -39,19 +115,152 @@ def exportAnnoPdf(annotations,outdir,verbose=True):
             exportPdf(fii,outdir,annoii,verbose)
         except:
             faillist.append(fnameii)
+        else:
+            if manifest is not None:
+                manifest.update(os.path.join(outdir,fnameii),keys[idii])
 
     return faillist
 
 
+def _exportPdfJob(fin,outdir,annotations):
+    '''Run exportPdf() in a worker process
+
+    Return True if succeeded, False otherwise.
+    '''
+    try:
+        exportPdf(fin,outdir,annotations,False)
+        return True
+    except:
+        return False
+
+
+
+# ioctl request to clone a file on Linux, see ioctl_ficlone(2)
+FICLONE=0x40049409
+
+#----------------Copy files, with links if possible----------------
+class PdfCopier(object):
+
+    modes=['hard','reflink']
+
+    def __init__(self,linkmode=None):
+        '''Obj to copy un-annotated PDFs and keep count of the strategies used.
+
+        <linkmode>: str or None. If 'hard', create hard links. If 'reflink',
+                    create copy-on-write clones (Linux, on Btrfs, XFS etc.).
+                    Fall back to a plain copy if the link can't be made,
+                    e.g. when the output is on a different filesystem.
+                    If None, always copy.
+
+        NOTE that a hard link shares its content with the Mendeley file,
+        changes to one will show up in the other.
+        '''
+        if linkmode is not None and linkmode not in self.modes:
+            raise Exception("Unknown link mode: %s" %linkmode)
+        self.linkmode=linkmode
+        self.counts={}
+        self.nbytes=0
+        self.seconds=0.
+
+    def copy(self,src,dst):
+        '''Copy <src> to <dst>, overwriting <dst>
+
+        The link or copy is made at a temp name in the folder of <dst>,
+        and renamed to <dst>, so that an existing <dst> is kept if it
+        fails.
+
+        Return <strategy>: str, 'hard link', 'reflink' or 'copy'.
+        '''
+        t0=time.time()
+        folder,filename=os.path.split(os.path.abspath(dst))
+        fd,tmpname=tempfile.mkstemp(prefix='.%s.' %filename,suffix='.tmp',\
+                dir=folder)
+        os.close(fd)
+
+        try:
+            strategy=None
+            if self.linkmode=='hard':
+                try:
+                    os.remove(tmpname)
+                    os.link(src,tmpname)
+                    strategy='hard link'
+                except (OSError,AttributeError):
+                    pass
+            elif self.linkmode=='reflink':
+                try:
+                    reflink(src,tmpname)
+                    strategy='reflink'
+                except (IOError,OSError,ImportError):
+                    pass
+
+            if strategy is None:
+                shutil.copy2(src,tmpname)
+                strategy='copy'
+
+            if os.name=='nt' and os.path.lexists(dst):
+                os.remove(dst)
+            os.rename(tmpname,dst)
+        finally:
+            # rename() does nothing if both are links to the same file
+            if os.path.lexists(tmpname):
+                os.remove(tmpname)
+
+        self.counts[strategy]=self.counts.get(strategy,0)+1
+        self.nbytes+=os.path.getsize(dst)
+        self.seconds+=time.time()-t0
+
+        return strategy
+
+    def summary(self):
+        '''Get a summary string of number of files, size and throughput
+        '''
+        num=sum(self.counts.values())
+        mb=self.nbytes/1024.**2
+        rate=mb/self.seconds if self.seconds>0 else 0.
+        strategies=', '.join(['%d by %s' %(vv,kk) for kk,vv in\
+                sorted(self.counts.items())])
+        return 'Copied %d PDFs (%.1f MB) in %.1f s, %.1f MB/s: %s.'\
+                %(num,mb,self.seconds,rate,strategies)
+
+
+def reflink(src,dst):
+    '''Create a copy-on-write clone of <src> at <dst>
+
+    Raise IOError if the filesystem doesn't support it, ImportError if
+    not on a Unix.
+    '''
+    import fcntl
+    try:
+        with open(src,'rb') as fin:
+            with open(dst,'wb') as fout:
+                fcntl.ioctl(fout.fileno(),FICLONE,fin.fileno())
+    except:
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+    shutil.copystat(src,dst)
+
+
 
 #---------------------Copy PDF to target location---------------------
-def copyPdf(doclist,outdir,verbose=True):
+def copyPdf(doclist,outdir,verbose=True,manifest=None,copier=None):
     '''Copy PDF to target location
+
+    <manifest>: ExportManifest obj or None. If given, skip PDFs whose
+                inputs and output are unchanged since the last export,
+                and record the copied ones.
+    <copier>: PdfCopier obj or None. If given, copy with it, to use links
+              and/or to keep count of copied files. If None, copy with
+              a new PdfCopier.
     '''
+    if copier is None:
+        copier=PdfCopier()
+
     if not os.path.isdir(outdir):
         os.makedirs(outdir)
 
     faillist=[]
+    nskip=0
 
     num=len(doclist)
     for ii,docii in enumerate(doclist):
@@ -67,14 +276,26 @@ def copyPdf(doclist,outdir,verbose=True):
             faillist.append(pathii)
             continue
 
+        if manifest is not None:
+            keyii=manifest.docKey(docii)
+            if manifest.isCurrent(targetname,keyii):
+                nskip+=1
+                continue
+
         if verbose:
             printNumHeader('Copying file:',ii+1,num,3)
             printInd(filename,4)
 
         try:
-            shutil.copy2(pathii,targetname)
+            copier.copy(pathii,targetname)
         except:
             faillist.append(filename)
+        else:
+            if manifest is not None:
+                manifest.update(targetname,keyii)
+
+    if verbose and nskip>0:
+        printInd('Skip %d unchanged PDFs.' %nskip,4)
 
     return faillist
 
@@ -98,6 +319,8 @@ def exportPdf(fin,outdir,annotations,verbose):
 
     try:
         inpdf = PyPDF2.PdfFileReader(open(fin, 'rb'))
+        incremental = not inpdf.isEncrypted and\
+                pdfannotation.canAppendXref(inpdf)
         if inpdf.isEncrypted:
             # PyPDF2 seems to think some files are encrypted even
             # if they are not. We just ignore the encryption.
@@ -108,11 +331,19 @@ def exportPdf(fin,outdir,annotations,verbose):
         print('Could not find pdf file %s' %fin)
         return
 
-    outpdf = PyPDF2.PdfFileWriter()
+    #----------Append annotations to original bytes----------
+    # Only annotated pages are touched. Encrypted files need their new
+    # strings encrypted, and files with xref streams can't take an xref
+    # table, so are still rewritten as a whole.
+    if incremental:
+        outpdf = pdfannotation.IncrementalWriter(inpdf)
+        pages=[ii for ii in annotations.pages if\
+                1<=ii<=inpdf.getNumPages()]
+    else:
+        outpdf = PyPDF2.PdfFileWriter()
+        pages=range(1,inpdf.getNumPages()+1)
 
     #----------------Loop through pages----------------
-    pages=range(1,inpdf.getNumPages()+1)
-
     for pii in pages:
 
         inpg = inpdf.getPage(pii-1)
@@ -132,18 +363,35 @@ def exportPdf(fin,outdir,annotations,verbose):
                         cdate=njj["cdate"])
                 inpg=pdfannotation.addAnnotation(inpg,outpdf,note)
 
-        outpdf.addPage(inpg)
+        if incremental:
+            outpdf.updatePage(inpg)
+        else:
+            outpdf.addPage(inpg)
 
     #-----------------------Save-----------------------
     filename=annotations.filename
     if not os.path.isdir(outdir):
         os.makedirs(outdir)
     abpath_out=os.path.join(outdir,filename)
-    if os.path.isfile(abpath_out):
-        os.remove(abpath_out)
 
-    with open(abpath_out, mode='wb') as fout:
-        outpdf.write(fout)
+    # Write to a temp file and rename into place, so that <abpath_out>
+    # is never left half-written.
+    fd,tmpname=tempfile.mkstemp(prefix='.%s.' %filename,suffix='.tmp',\
+            dir=outdir)
+    try:
+        with os.fdopen(fd,'wb') as fout:
+            outpdf.write(fout)
+        # mkstemp() creates files readable by the user only
+        umask=os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpname,0o666 & ~umask)
+        if os.name=='nt' and os.path.isfile(abpath_out):
+            os.remove(abpath_out)
+        os.rename(tmpname,abpath_out)
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
 
     return
 
@@ -33,7 +33,8 @@ import wordfix
 #------Store highlighted texts with metadata------
 class Anno(object):
     def __init__(self,text,ctime=None,title=None,author=None,\
-            note_author=None,page=None,citationkey=None,tags=None):
+            note_author=None,page=None,citationkey=None,tags=None,\
+            rect=None,color=None,sidebar=False):
 
         self.text=text
         self.ctime=ctime
@@ -43,6 +44,11 @@ class Anno(object):
         self.page=page
         self.citationkey=citationkey
         self.tags=tags
+        # [x1,y1,x2,y2] of the annotation, origin at bottom-left
+        self.rect=rect
+        self.color=color
+        # True for a side-bar note of the document, with no rect and ctime
+        self.sidebar=sidebar
 
         if tags is None:
             self.tags='None'
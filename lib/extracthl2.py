@@ -28,15 +28,40 @@ from pdfminer.pdfinterp import PDFPageInterpreter
 from pdfminer.pdfdevice import PDFDevice
 from pdfminer.layout import LAParams
 from pdfminer.converter import PDFPageAggregator
+from pdfminer.pdftypes import dict_value, list_value, int_value
+from pdfminer.pdftypes import PDFStream, resolve1
+from pdfminer.psparser import LIT, literal_name
+from pdfminer.cmapdb import CMapDB
 from pdfminer.layout import LTTextBox, LTTextLine, LTAnno,\
-        LTTextBoxHorizontal, LTTextLineHorizontal, LTChar
+        LTTextBoxHorizontal, LTTextLineHorizontal, LTChar, LTFigure, LTPage
 from numpy import sqrt, argsort
 
 from subprocess import Popen, PIPE
+from xml.sax.saxutils import unescape
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import hashlib
+import math
 import tools
-import time
 import wordfix
 import os
+import re
+
+
+# Layout engines: 'layout' groups chars into boxes by the full layout
+# analysis of pdfminer, 'chars' only groups chars near the highlights,
+# see groupChars().
+ENGINES=['layout','chars']
+
+LITERAL_PAGE=LIT('Page')
+LITERAL_PAGES=LIT('Pages')
+
+# Size limit of fonts shared by an ExtractSession, in bytes of font programs
+MAXFONTSIZE=64*1024**2
+# Max number of predefined CMaps (CJK encodings) kept in memory
+MAXCMAPS=16
+# Max nesting depth of a font spec to get a key of
+MAXSPECDEPTH=8
 
 
 #------Test availability of pdftotext-------------
@@ -44,7 +69,7 @@ def checkPdftotext():
     try:
         pp=Popen(['pdftotext'],stdout=PIPE,stderr=PIPE)
 	re=pp.communicate()
-	if '-x' in re[1] and '-y' in re[1]:
+	if '-bbox' in re[1]:
             isavail=True
         else:
             isavail=False
@@ -56,10 +81,236 @@ def checkPdftotext():
 
 
 
+#------Word boxes of PDF pages obtained from pdftotext------
+class PdftotextWords(object):
+
+    _page_re=re.compile(r'<page width="([-\d.]+)" height="([-\d.]+)">')
+    _word_re=re.compile(r'<word xMin="([-\d.]+)" yMin="([-\d.]+)" '\
+            r'xMax="([-\d.]+)" yMax="([-\d.]+)">(.*?)</word>')
+    _entities={'&quot;': '"', '&apos;': "'"}
+
+    def __init__(self,filename):
+        '''Obj to hold word bounding boxes of pages in a PDF.
+
+        <filename>: str, path to PDF file.
+
+        pdftotext is run once for each requested page, with the -bbox
+        option, and the words are kept in memory so that all highlights
+        in that page are answered from the same result.
+        '''
+        self.filename=os.path.abspath(filename)
+        self.pages={}
+
+    def getPage(self,page):
+        '''Get (page height, word list) of a page (1-based)
+
+        Each word is (x1,y1,x2,y2,text), with origin at the bottom-left,
+        same as the Mendeley highlight rects.
+
+        Raise an Exception if pdftotext fails, or gives no such page, so
+        that the PDF is reported as failed and no empty texts are cached.
+        '''
+        if page in self.pages:
+            return self.pages[page]
+
+        args=['pdftotext','-f',str(page),'-l',str(page),'-bbox',\
+                self.filename,'-']
+        pp=Popen(args,stdout=PIPE,stderr=PIPE)
+        out,err=pp.communicate()
+        if pp.returncode!=0:
+            raise Exception('pdftotext failed on page %d of %s: %s'\
+                    %(page,self.filename,tools.deu(err).strip()))
+        out=tools.deu(out)
+
+        pmatch=self._page_re.search(out)
+        if pmatch is None:
+            raise Exception('pdftotext gave no page %d of %s'\
+                    %(page,self.filename))
+        pheight=float(pmatch.group(2))
+        words=[]
+        for mii in self._word_re.finditer(out):
+            x1,y1,x2,y2=[float(ii) for ii in mii.groups()[:4]]
+            # pdftotext has origin at top-left.
+            words.append((x1,pheight-y2,x2,pheight-y1,\
+                    unescape(mii.group(5),self._entities)))
+
+        self.pages[page]=(pheight,words)
+        return self.pages[page]
+
+    def getText(self,page,rect):
+        '''Get text within a rect in a page
+
+        <page>: int, page number (1-based).
+        <rect>: list, [x1,y1,x2,y2] with origin at bottom-left.
+
+        Like the cropping of pdftotext, a char is taken if its center
+        falls inside <rect>. Char boxes are obtained by splitting the
+        word box evenly.
+        '''
+        x1,y1,x2,y2=rect
+        pheight,words=self.getPage(page)
+        texts=[]
+
+        for wx1,wy1,wx2,wy2,word in words:
+            if not y1<=(wy1+wy2)/2.<=y2:
+                continue
+            if wx2<x1 or wx1>x2:
+                continue
+            cw=(wx2-wx1)/max(len(word),1)
+            chars=[cc for jj,cc in enumerate(word) if\
+                    x1<=wx1+(jj+0.5)*cw<=x2]
+            if len(chars)>0:
+                texts.append(u''.join(chars))
+
+        return u' '.join(texts)
+
+
+
+
+#------Test if 2 bboxes overlap------
+def overlap(bbox1,bbox2):
+    '''Test if 2 bboxes overlap
+
+    <bbox1>, <bbox2>: (x1,y1,x2,y2) with origin at bottom-left.
+
+    Same as is_hoverlap() and is_voverlap() of pdfminer layout objs,
+    without having to create a dummy layout obj for a highlight.
+    '''
+    return bbox2[0]<=bbox1[2] and bbox1[0]<=bbox2[2] and\
+            bbox2[1]<=bbox1[3] and bbox1[1]<=bbox2[3]
+
+
+
+
+#------Spatial index over the text in a page layout------
+class PageIndex(object):
+
+    def __init__(self,objs,cellsize=50.):
+        '''Obj to hold a spatial index over the text in a page layout.
+
+        <objs>: list, layout objs of a page, e.g. as returned by sortDiag().
+        <cellsize>: float, size (pt) of the grid cells text boxes are
+                    hashed into.
+
+        Text boxes are put into a uniform grid so that the boxes touched
+        by a highlight are found without testing every box in the page.
+        Chars of a text line are sorted by their left edge when the line
+        is first hit, so that those inside a highlight are found by
+        bisection instead of a scan through the line.
+        '''
+        self.cellsize=float(cellsize)
+        self.boxes=[]
+        self.grid={}
+        self.lines={}
+
+        for objii in objs:
+            if type(objii)!=LTTextBox and\
+                    type(objii)!=LTTextBoxHorizontal:
+                continue
+            for cellii in self._cells(objii.bbox):
+                self.grid.setdefault(cellii,[]).append(len(self.boxes))
+            self.boxes.append(objii)
+
+    def _cells(self,bbox):
+        x1,y1,x2,y2=[int(math.floor(ii/self.cellsize)) for ii in bbox]
+        return [(xx,yy) for xx in range(x1,x2+1) for yy in range(y1,y2+1)]
+
+    def getBoxes(self,rect):
+        '''Get text boxes overlapping a rect, in the order of <objs>'''
+        idx=set()
+        for cellii in self._cells(rect):
+            idx.update(self.grid.get(cellii,[]))
+        return [self.boxes[ii] for ii in sorted(idx) if\
+                overlap(self.boxes[ii].bbox,rect)]
+
+    def groupByBox(self,anno):
+        '''Group highlights by the text boxes they overlap
+
+        Return <result>: dict, id of text box as key, list of highlights
+                         overlapping the box as value, in the order of
+                         <anno>.
+        '''
+        result={}
+        for hii in anno:
+            for boxjj in self.getBoxes(hii['rect']):
+                result.setdefault(id(boxjj),[]).append(hii)
+        return result
+
+    def getLineText(self,line,rect):
+        '''Get texts from a text line that fall within a rect
+
+        Return <result>: list, texts of chars overlapping <rect>, and
+                         all LTAnno texts of the line, in line order.
+        '''
+        key=id(line)
+        if key not in self.lines:
+            annos=[]
+            chars=[]
+            maxw=0.
+            for jj,charjj in enumerate(line._objs):
+                if type(charjj)==LTAnno:
+                    annos.append((jj,charjj.get_text()))
+                elif type(charjj)==LTChar:
+                    chars.append((charjj.x0,jj,charjj))
+                    maxw=max(maxw,charjj.x1-charjj.x0)
+            chars.sort()
+            self.lines[key]=(annos,chars,[ii[0] for ii in chars],maxw)
+
+        annos,chars,x0s,maxw=self.lines[key]
+        lo=bisect_left(x0s,rect[0]-maxw-1.)
+        hi=bisect_right(x0s,rect[2])
+        hits=[(jj,charjj.get_text()) for x0,jj,charjj in chars[lo:hi]\
+                if overlap(charjj.bbox,rect)]
+
+        return [ii[1] for ii in sorted(annos+hits)]
+
+
+
+
+#------Page layout with sorted boxes and lines, computed once------
+class PageLayout(object):
+
+    def __init__(self,layout=None,objs=None):
+        '''Obj to hold the analyzed layout of a page.
+
+        <layout>: LTPage obj, as returned by PDFPageAggregator.get_result().
+        <objs>: list or None, layout objs already ordered. If None, get
+                from <layout> by sortDiag() and fineTuneOrder().
+
+        Boxes are ordered, and the spatial index built, once per page.
+        Lines of a box and their line/char gaps are computed on the 1st
+        request and memoized, so that highlights sharing a box don't
+        re-sort it.
+        '''
+        if objs is None:
+            objs=fineTuneOrder(sortDiag(layout))
+        self.objs=objs
+        self.index=PageIndex(objs)
+        self._lines={}
+        self._gaps={}
+
+    def getLines(self,box):
+        '''Get lines of a box, sorted by sortY()'''
+        key=id(box)
+        if key not in self._lines:
+            self._lines[key]=sortY(box._objs)
+        return self._lines[key]
+
+    def getGaps(self,box):
+        '''Get (linegap, chargap) of a box, see measureGap()'''
+        key=id(box)
+        if key not in self._gaps:
+            self._gaps[key]=measureGap(self.getLines(box))
+        return self._gaps[key]
+
+
+
+
 #------Store highlighted texts with metadata------
 class Anno(object):
     def __init__(self,text,ctime=None,title=None,author=None,\
-            note_author=None,page=None,citationkey=None,tags=None):
+            note_author=None,page=None,citationkey=None,tags=None,\
+            rect=None,color=None,sidebar=False):
 
         self.text=text
         self.ctime=ctime
@@ -69,6 +320,11 @@ class Anno(object):
         self.page=page
         self.citationkey=citationkey
         self.tags=tags
+        # [x1,y1,x2,y2] of the annotation, origin at bottom-left
+        self.rect=rect
+        self.color=color
+        # True for a side-bar note of the document, with no rect and ctime
+        self.sidebar=sidebar
 
         if tags is None:
             self.tags='None'
@@ -98,47 +354,38 @@ Tags:               %s
 
 
 #-------Locate and extract strings from a page layout obj-------
-def findStrFromBox(anno,box,verbose=True):
+def findStrFromBox(anno,box,page=None,verbose=True):
     '''Locate and extract strings from a page layout obj
 
     Extract text using pdfminer
+
+    <page>: PageLayout obj of the page <box> is in. If None, one is
+            created for <box> alone.
     '''
 
+    if page is None:
+        page=PageLayout(objs=[box,])
+
     texts=u''
     num=0
 
     #----------------Loop through annos----------------
     for ii,hii in enumerate(anno):
 
-        #----------Create a dummy LTTextLine obj----------
         hiibox=hii['rect']
-        dummy=LTTextLine(hiibox)
-        dummy.set_bbox(hiibox)   #Needs this step
-    
-        if box.is_hoverlap(dummy) and box.is_voverlap(dummy):
+        if overlap(box.bbox,hiibox):
             textii=[]
             num+=1
 
-            lines=sortY(box._objs)
+            lines=page.getLines(box)
 
             #----------------Loop through lines----------------
             for lineii in lines:
                 if type(lineii)!=LTTextLine and\
                         type(lineii)!=LTTextLineHorizontal:
                     continue
-                if lineii.is_hoverlap(dummy) and\
-                        lineii.is_voverlap(dummy):
-                    #chars=sortX(lineii._objs)
-                    chars=lineii._objs
-
-                    #----------------Loop through chars----------------
-                    for charii in chars:
-                        if type(charii)==LTAnno:
-                            textii.append(charii.get_text())
-                        elif type(charii)==LTChar:
-                            if charii.is_hoverlap(dummy) and\
-                                    charii.is_voverlap(dummy):
-                                textii.append(charii.get_text())
+                if overlap(lineii.bbox,hiibox):
+                    textii.extend(page.index.getLineText(lineii,hiibox))
 
             #----------------Concatenate texts----------------
             textii=u''.join(textii).strip(' ')
@@ -154,7 +401,7 @@ def findStrFromBox(anno,box,verbose=True):
                 joiner=u' '
 
             #---------------Jump---------------
-            linegap,chargap=measureGap(lines)
+            linegap,chargap=page.getGaps(box)
             textii=textii.strip()
             if ii==0 or len(texts)==0:
                 texts+=joiner+textii
@@ -181,55 +428,42 @@ def findStrFromBox(anno,box,verbose=True):
 
 
 #-------Locate and extract strings from a page layout obj-------
-def findStrFromBox2(anno,box,filename,pheight,verbose=True):
+def findStrFromBox2(anno,box,pdfwords,page=None,verbose=True):
     '''Locate and extract strings from a page layout obj
 
     Extract text using pdftotext
+
+    <pdfwords>: PdftotextWords obj of the PDF.
+    <page>: PageLayout obj of the page <box> is in. If None, one is
+            created for <box> alone.
     '''
 
+    if page is None:
+        page=PageLayout(objs=[box,])
+
 
     texts=u''
     num=0
-    # pdftotext requires int coordinates, scale default dpi of
-    # pdftotext (72) to 720, and multiply coordinates by 10.
-    coord2str=lambda x: int(round(10.*x))  
     
     #----------------Loop through annos----------------
     for ii,hii in enumerate(anno):
 
-        #----------Create a dummy LTTextLine obj----------
         hiibox=hii['rect']
-        dummy=LTTextLine(hiibox)
-        dummy.set_bbox(hiibox)   #Needs this step
-
-        if box.is_hoverlap(dummy) and box.is_voverlap(dummy):
+        if overlap(box.bbox,hiibox):
             textii=[]
             num+=1
 
-            lines=sortY(box._objs)
+            lines=page.getLines(box)
 
             #----------------Loop through lines----------------
             for lineii in lines:
                 if type(lineii)!=LTTextLine and\
                         type(lineii)!=LTTextLineHorizontal:
                     continue
-                if lineii.is_hoverlap(dummy) and\
-                        lineii.is_voverlap(dummy):
-
-                    #------Call pdftotext and same to a temp file------
-                    # NOTE: pdftotext coordinate has origin at top-left.
-                    # Coordinates from Mendeley has origin at bottom-left.
-                    args=['pdftotext','-f',hii['page'],'-l',hii['page'],'-r',720,\
-                            '-x',coord2str(hiibox[0]),'-y',coord2str(pheight-hiibox[3]),\
-                            '-W',coord2str(hiibox[2]-hiibox[0]),'-H',coord2str(hiibox[3]-hiibox[1]),\
-                            os.path.abspath(filename),'tmp.txt']
-                    args=map(str,args)
-
-                    pp=Popen(args)
-                    while pp.poll() !=0:
-                        time.sleep(0.01)
-
-                    tii=tools.readFile('tmp.txt',False)
+                if overlap(lineii.bbox,hiibox):
+
+                    #------Get words in highlight from pdftotext------
+                    tii=pdfwords.getText(hii['page'],hiibox)
                     textii.append(tii)
 
                     # break to avoid double sampling. Lines from lineii may
@@ -250,7 +484,7 @@ def findStrFromBox2(anno,box,filename,pheight,verbose=True):
                 joiner=u' '
 
             #---------------Jump---------------
-            linegap,chargap=measureGap(lines)
+            linegap,chargap=page.getGaps(box)
             textii=textii.strip()
             if ii==0 or len(texts)==0:
                 texts+=joiner+textii
@@ -548,9 +782,425 @@ def sortAnnoY(objs,verbose=True):
 
 
 
+#----------------------Get selected pages from a PDF----------------------
+class PageTreeError(Exception):
+    '''Page tree with /Count not matching its kids, or a loop'''
+    pass
+
+
+def getPages(document,pagenos,verbose=True):
+    '''Get selected pages from a PDF
+
+    <document>: PDFDocument obj.
+    <pagenos>: set, page numbers (1-based) to get.
+
+    Yield (pageno, PDFPage obj), in page order.
+
+    Same walk through the page tree as PDFPage.create_pages(), except
+    that Pages nodes containing none of <pagenos> are skipped using their
+    /Count, without resolving their kids, and the walk stops after the
+    highest page in <pagenos>. PDFPage objs are only created for
+    <pagenos>.
+
+    /Count of a skipped node is checked against the /Count of its
+    siblings and parent. If the counts don't add up, or the page tree
+    gives no page, fall back to walking all pages.
+    '''
+
+    if len(pagenos)==0:
+        return
+    lastpage=max(pagenos)
+
+    if 'Pages' in document.catalog:
+        try:
+            pages=searchPages(document,pagenos)
+        except PageTreeError:
+            pages=[]
+    else:
+        pages=[]
+
+    #--------------No usable page tree, fall back--------------
+    if len(pages)==0:
+        for ii,page in enumerate(PDFPage.create_pages(document)):
+            if ii+1 in pagenos:
+                yield ii+1, page
+            if ii+1>=lastpage:
+                break
+        return
+
+    for pageno,objid,tree in pages:
+        yield pageno, PDFPage(document,objid,tree)
+
+
+
+def searchPages(document,pagenos):
+    '''Find selected pages in the page tree, skipping subtrees by /Count
+
+    <document>: PDFDocument obj.
+    <pagenos>: set, page numbers (1-based) to get.
+
+    Return <pages>: list, (pageno, objid, page dict) in page order.
+
+    Raise PageTreeError if the /Count of a Pages node differs from the
+    sum of its kids, or the kids walked through.
+    '''
+    lastpage=max(pagenos)
+    pages=[]
+    # Number of pages walked through so far
+    walked=[0,]
+    seen=set()
+
+    def getNode(obj,parent):
+        if isinstance(obj,int):
+            objid=obj
+            tree=dict_value(document.getobj(objid)).copy()
+        else:
+            objid=obj.objid
+            tree=dict_value(obj).copy()
+        if objid in seen:
+            raise PageTreeError('Loop in page tree at object %s' %objid)
+        seen.add(objid)
+        for kk,vv in parent.items():
+            if kk in PDFPage.INHERITABLE_ATTRS and kk not in tree:
+                tree[kk]=vv
+        return objid,tree
+
+    def getCount(tree):
+        if tree.get('Type') is LITERAL_PAGES and 'Kids' in tree:
+            count=resolve1(tree.get('Count'))
+            if not isinstance(count,int) or count<0:
+                raise PageTreeError('Invalid /Count: %r' %count)
+            return count
+        elif tree.get('Type') is LITERAL_PAGE:
+            return 1
+        return 0
+
+    def search(objid,tree,count):
+        if tree.get('Type') is LITERAL_PAGE:
+            walked[0]+=1
+            if walked[0] in pagenos:
+                pages.append((walked[0],objid,tree))
+            return
+        if count==0:
+            return
+
+        #-------------Check /Count against kids-------------
+        kids=[getNode(kid,tree) for kid in list_value(tree['Kids'])]
+        counts=[getCount(kidii[1]) for kidii in kids]
+        if sum(counts)!=count:
+            raise PageTreeError('/Count %d of object %s, kids have %d'\
+                    %(count,objid,sum(counts)))
+
+        start=walked[0]
+        for (kidid,kidtree),countii in zip(kids,counts):
+            if walked[0]>=lastpage:
+                return
+
+            #-----------Skip subtrees with no wanted page-----------
+            if not any(walked[0]<ii<=walked[0]+countii for ii in pagenos):
+                walked[0]+=countii
+                continue
+            search(kidid,kidtree,countii)
+
+        if walked[0]<lastpage and walked[0]-start!=count:
+            raise PageTreeError('/Count %d of object %s, walked %d'\
+                    %(count,objid,walked[0]-start))
+
+    objid,tree=getNode(document.catalog['Pages'],document.catalog)
+    search(objid,tree,getCount(tree))
+
+    return pages
+
+
+
+
+
+#--------------Page aggregator keeping chars near highlights--------------
+class CharAggregator(PDFPageAggregator):
+
+    def __init__(self,rsrcmgr,pageno=1):
+        '''Page aggregator without layout analysis, for the 'chars' engine
+
+        Set <rects> to the highlight rects before processing a page. Chars
+        in horizontal, unrotated text more than 2 highlight heights above
+        or below all highlights are skipped before an LTChar is made for
+        them. Other chars are kept as they are drawn.
+        '''
+        PDFPageAggregator.__init__(self,rsrcmgr,pageno=pageno,laparams=None)
+        self.rects=None
+
+    def render_char(self,matrix,font,fontsize,scaling,rise,cid):
+        if self.rects is not None and not font.is_vertical():
+            a,b,c,d,e,f=matrix
+            if b==0 and c==0:
+                ty=font.get_descent()*fontsize+rise
+                y0=d*ty+f
+                y1=d*(ty+font.get_height()*fontsize)+f
+                if not isNear((0,min(y0,y1),0,max(y0,y1)),self.rects):
+                    return font.char_width(cid)*fontsize*scaling
+
+        return PDFPageAggregator.render_char(self,matrix,font,fontsize,\
+                scaling,rise,cid)
+
+
+
+
+def isNear(bbox,rects):
+    '''Check if a bbox is within 2 heights of any rect vertically'''
+    for rii in rects:
+        margin=2*(rii[3]-rii[1])
+        if bbox[3]>=rii[1]-margin and bbox[1]<=rii[3]+margin:
+            return True
+    return False
+
+
+
+
+#--------------------Group chars into text boxes--------------------
+def groupChars(layout,laparams=None,verbose=True):
+    '''Group chars into text boxes
+
+    <layout>: LTPage obj from a CharAggregator, holding chars as they are
+              drawn.
+    <laparams>: LAParams obj, margins to group chars with. If None, use
+                the defaults.
+
+    Return <page>: LTPage obj holding LTTextBoxHorizontal objs.
+
+    A cheap stand-in for the layout analysis of pdfminer, for the
+    'chars' engine. Like pdfminer, consecutive chars that are
+    horizontally aligned form a line. Then each line joins the box of
+    the line just above it, if their heights and left or right edges
+    are close.
+    '''
+
+    if laparams is None:
+        laparams=LAParams()
+
+    def getChars(objs):
+        for objii in objs:
+            if isinstance(objii,LTChar):
+                yield objii
+            elif isinstance(objii,LTFigure):
+                for charjj in getChars(objii):
+                    yield charjj
+
+    #--------------Chars to lines--------------
+    lines=[]
+    prev=None
+    for charii in getChars(layout):
+        if prev is not None and\
+                prev.is_compatible(charii) and\
+                prev.is_voverlap(charii) and\
+                min(prev.height,charii.height)*laparams.line_overlap<\
+                    prev.voverlap(charii) and\
+                prev.hdistance(charii)<\
+                    max(prev.width,charii.width)*laparams.char_margin:
+            lines[-1].add(charii)
+        else:
+            lines.append(LTTextLineHorizontal(laparams.word_margin))
+            lines[-1].add(charii)
+        prev=charii
+
+    #--------------Lines to boxes--------------
+    boxes=[]
+    for lineii in sorted(lines,key=lambda x:-x.y1):
+        lineii.analyze(laparams)
+        dd=laparams.line_margin*lineii.height
+
+        for boxjj in boxes[::-1]:
+            lastjj=boxjj._objs[-1]
+            if abs(lastjj.height-lineii.height)<dd and\
+                    (abs(lastjj.x0-lineii.x0)<dd or\
+                    abs(lastjj.x1-lineii.x1)<dd) and\
+                    lineii.y1>=lastjj.y0-dd and lineii.y0<=lastjj.y0:
+                boxjj.add(lineii)
+                break
+        else:
+            boxes.append(LTTextBoxHorizontal())
+            boxes[-1].add(lineii)
+
+    page=LTPage(layout.pageid,layout.bbox,layout.rotate)
+    for boxii in boxes:
+        page.add(boxii)
+
+    return page
+
+
+
+
+#------------Resource manager shared across documents------------
+class ExtractSession(PDFResourceManager):
+
+    def __init__(self,maxsize=MAXFONTSIZE,maxcmaps=MAXCMAPS):
+        '''Resource manager shared by all PDFs in an extraction run
+
+        <maxsize>: int, size limit (bytes of decoded font programs and
+                   ToUnicode maps) of shared fonts. Least recently used
+                   fonts are dropped to keep below.
+        <maxcmaps>: int, max number of predefined CMaps kept in pdfminer's
+                    CMapDB cache. The cache is emptied when exceeded.
+
+        pdfminer caches fonts by object id, which is only valid within a
+        document, so a new PDFResourceManager is needed per PDF and all
+        fonts are parsed again. This one keys shared fonts by the contents
+        of their specs (see getFontKey()), so the same embedded font in
+        2 PDFs is parsed once per process. Create one per extractAnnos()
+        call or worker process, and pass it to init().
+
+        Shared fonts are parsed from a copy of their spec (see copySpec()),
+        so they keep no refs to, and don't keep alive, their documents.
+        '''
+        PDFResourceManager.__init__(self,caching=True)
+        self.maxsize=maxsize
+        self.maxcmaps=maxcmaps
+        self.size=0
+        self._shared_fonts=OrderedDict()
+
+    def newDocument(self):
+        '''Forget object ids of the last document
+
+        Return self, to be used as the resource manager of a document.
+        '''
+        self._cached_fonts={}
+        trimCMapCache(self.maxcmaps)
+        return self
+
+    def get_font(self,objid,spec):
+        if objid and objid in self._cached_fonts:
+            return self._cached_fonts[objid]
+
+        key=getFontKey(spec)[0]
+        if key is None:
+            return PDFResourceManager.get_font(self,objid,spec)
+
+        if key in self._shared_fonts:
+            font,size=self._shared_fonts.pop(key)
+        else:
+            size=[1024]
+            try:
+                spec=copySpec(spec,size)
+            except Exception:
+                return PDFResourceManager.get_font(self,objid,spec)
+            size=size[0]
+            font=PDFResourceManager.get_font(self,None,spec)
+            self.size+=size
+            while self.size>self.maxsize and len(self._shared_fonts)>0:
+                self.size-=self._shared_fonts.popitem(last=False)[1][1]
+        self._shared_fonts[key]=(font,size)
+
+        if objid:
+            self._cached_fonts[objid]=font
+        return font
+
+
+
+
+def getFontKey(spec,verbose=True):
+    '''Get a key of a font from the contents of its spec
+
+    <spec>: dict, font dict of a PDF.
+
+    Return <key>: str, sha1 of the spec, with refs resolved and streams
+                  replaced by their data. None if the font can't be shared.
+           <size>: int, rough size of the font, bytes of its streams.
+    '''
+
+    sha=hashlib.sha1()
+    size=[1024]
+
+    def walk(obj,depth):
+        if depth>MAXSPECDEPTH:
+            raise ValueError('Font spec too deep.')
+        obj=resolve1(obj)
+        if isinstance(obj,dict):
+            sha.update('<<')
+            for kk in sorted(obj.keys()):
+                sha.update(repr(kk))
+                walk(obj[kk],depth+1)
+            sha.update('>>')
+        elif isinstance(obj,(list,tuple)):
+            sha.update('[')
+            for vv in obj:
+                walk(vv,depth+1)
+            sha.update(']')
+        elif isinstance(obj,PDFStream):
+            data=obj.rawdata if obj.rawdata is not None else obj.data
+            sha.update('stream%d:' %len(data))
+            sha.update(data)
+            size[0]+=len(data)
+            walk(obj.attrs,depth+1)
+        else:
+            sha.update(repr(obj)+' ')
+
+    try:
+        spec=dict_value(spec)
+        # Type3 glyphs are drawn with the resources of the document
+        if literal_name(resolve1(spec.get('Subtype')))=='Type3':
+            return None,0
+        walk(spec,0)
+    except Exception:
+        return None,0
+
+    return sha.hexdigest(),size[0]
+
+
+
+
+def copySpec(spec,size=None,depth=0):
+    '''Copy a font spec, keeping no refs to its document
+
+    <spec>: dict, font dict of a PDF.
+    <size>: list or None. If given, bytes of stream data copied are added
+            to size[0].
+
+    Return <result>: dict, with refs resolved, and streams replaced by
+                     new ones holding their decoded data.
+    '''
+    if depth>MAXSPECDEPTH:
+        raise ValueError('Font spec too deep.')
+    obj=resolve1(spec)
+    if isinstance(obj,dict):
+        return dict([(kk,copySpec(vv,size,depth+1)) for kk,vv in obj.items()])
+    elif isinstance(obj,(list,tuple)):
+        return [copySpec(vv,size,depth+1) for vv in obj]
+    elif isinstance(obj,PDFStream):
+        data=obj.get_data()
+        attrs=copySpec(obj.attrs,size,depth+1)
+        # Data is decoded already
+        for kk in ['Filter','F','DecodeParms','DP']:
+            attrs.pop(kk,None)
+        result=PDFStream(attrs,data)
+        result.data=data
+        if size is not None:
+            size[0]+=len(data)
+        return result
+    return obj
+
+
+def trimCMapCache(maxcmaps):
+    '''Empty pdfminer's cache of predefined CMaps if it holds > <maxcmaps>
+
+    CMapDB has no API for this, the cache dicts are private attributes.
+    Do nothing if a pdfminer version doesn't have them.
+    '''
+    caches=[getattr(CMapDB,ii,None) for ii in ['_cmap_cache','_umap_cache']]
+    caches=[ii for ii in caches if isinstance(ii,dict)]
+    if sum(map(len,caches))>maxcmaps:
+        for ii in caches:
+            ii.clear()
+
+
+
+
 #------------------------Initiate analysis objs------------------------
-def init(filename,verbose=True):
+def init(filename,engine='layout',session=None,verbose=True):
     '''Initiate analysis objs
+
+    <engine>: str, 'layout' or 'chars'. If 'chars', the device is a
+              CharAggregator, which skips the layout analysis.
+    <session>: ExtractSession obj or None. If given, use it as the resource
+               manager, sharing fonts with other PDFs in the session.
     '''
 
     fp = open(filename, 'rb')
@@ -563,7 +1213,10 @@ def init(filename,verbose=True):
     if not document.is_extractable:
         raise PDFTextExtractionNotAllowed
     # Create a PDF resource manager object that stores shared resources.
-    rsrcmgr = PDFResourceManager()
+    if session is not None:
+        rsrcmgr = session.newDocument()
+    else:
+        rsrcmgr = PDFResourceManager()
     # Create a PDF device object.
     device = PDFDevice(rsrcmgr)
     # Create a PDF interpreter object.
@@ -572,7 +1225,10 @@ def init(filename,verbose=True):
     laparams = LAParams()
 
     # Create a PDF page aggregator object.
-    device = PDFPageAggregator(rsrcmgr, laparams=laparams)
+    if engine=='chars':
+        device = CharAggregator(rsrcmgr)
+    else:
+        device = PDFPageAggregator(rsrcmgr, laparams=laparams)
     interpreter = PDFPageInterpreter(rsrcmgr, device)
 
     return document, interpreter, device
@@ -580,6 +1236,38 @@ def init(filename,verbose=True):
 
 
 
+#----------------Get rect and color of highlighted texts----------------
+def getBoxHighlight(anno,box):
+    '''Get the rect of the highlights in a text box
+
+    <anno>: list, highlight dicts touching <box>.
+    <box>: pdfminer layout obj, text box.
+
+    Return <rect>: list, [x1,y1,x2,y2] enclosing all highlights in <anno>
+                   overlapping <box>, origin at bottom-left.
+    '''
+    rects=[hii['rect'] for hii in anno if overlap(box.bbox,hii['rect'])]
+    return [min(ii[0] for ii in rects),min(ii[1] for ii in rects),\
+            max(ii[2] for ii in rects),max(ii[3] for ii in rects)]
+
+
+def getRectColor(anno,rect):
+    '''Get the color of the highlights in a rect
+
+    <anno>: list, highlight dicts of a page, in database order.
+    <rect>: list, [x1,y1,x2,y2] of a text box, see getBoxHighlight().
+
+    Return <color>: str or None, color of the 1st highlight in <anno>
+                    overlapping <rect>.
+    '''
+    for hii in anno:
+        if overlap(rect,hii['rect']):
+            return hii.get('color')
+    return None
+
+
+
+
 #----------------Get the latest creation time of annos----------------
 def getCtime(annos,verbose=True):
     '''Get the latest creation time of a list of annos
@@ -595,69 +1283,84 @@ def getCtime(annos,verbose=True):
 
 
 #----------------Extract highlighted texts from a PDF--------
-def extractHighlights(filename,anno,verbose=True):
+def extractHighlights(filename,anno,verbose=True,cache=None,filehash=None,\
+        engine='layout',session=None):
     '''Extract highlighted texts from a PDF
 
+    <cache>: AnnoCache obj or None. If given together with <filehash>,
+             pages with cached texts are not analyzed, and texts of the
+             other pages are added to the cache.
+    <filehash>: str or None, Files.hash of the PDF.
+    <engine>: str, 'layout' or 'chars', how chars are grouped into text
+              boxes, see ENGINES.
+    <session>: ExtractSession obj or None, resource manager shared with
+               other PDFs.
     '''
-    hlpages=anno.hlpages
+    hlpages=set(anno.hlpages)
     if len(hlpages)==0:
         return []
 
+    #---------------Get texts from cache---------------
+    pagetexts,keys=getCachedPages(anno,cache,filehash,\
+            'pdfminer' if engine=='layout' else 'pdfminer-%s' %engine)
+    todo=hlpages.difference(pagetexts)
+
     #--------------Get pdfmine instances--------------
-    document, interpreter, device=init(filename)
+    if len(todo)>0:
+        document, interpreter, device=init(filename,engine,session)
+    else:
+        document=None
 
     #----------------Loop through pages----------------
-    hltexts=[]
+    for pageno,page in getPages(document,todo):
 
-    for ii,page in enumerate(PDFPage.create_pages(document)):
+        annoii=anno.highlights[pageno]
+        anno_total=len(annoii)
+        anno_found=0
+        textsii=[]
 
-        #------------Get highlights in page------------
-        if len(hlpages)>0 and ii+1 in hlpages:
+        #------------Merge annos in single line------------
+        annoii=mergeLine(annoii)
 
-            annoii=anno.highlights[ii+1]
-            anno_total=len(annoii)
-            anno_found=0
+        #-----------Sort annotations vertically-----------
+        annoii=sortAnnoY(annoii)
 
-            #------------Merge annos in single line------------
-            annoii=mergeLine(annoii)
+        if engine=='chars':
+            device.rects=[hii['rect'] for hii in annoii]
+        interpreter.process_page(page)
+        layout = device.get_result()
+        if engine=='chars':
+            layout=groupChars(layout)
 
-            #-----------Sort annotations vertically-----------
-            annoii=sortAnnoY(annoii)
+        #--------Sort boxes diagnoally and refine ordering--------
+        pagelayout=PageLayout(layout)
 
-            interpreter.process_page(page)
-            layout = device.get_result()
+        #---------Find boxes touched by each highlight---------
+        boxhls=pagelayout.index.groupByBox(annoii)
 
-            #--------------Sort boxes diagnoally--------------
-            objs=sortDiag(layout)
+        #----------------Loop through boxes----------------
+        for jj,objj in enumerate(pagelayout.objs):
 
-            #-----------------Refine ordering-----------------
-            objs=fineTuneOrder(objs)
+            if type(objj)!=LTTextBox and\
+                    type(objj)!=LTTextBoxHorizontal:
+                continue
+            if id(objj) not in boxhls:
+                continue
+            textjj,numjj=findStrFromBox(boxhls[id(objj)],objj,pagelayout)
 
-            #----------------Loop through boxes----------------
-            for jj,objj in enumerate(objs):
+            if numjj>0:
+                textsii.append([textjj,getBoxHighlight(boxhls[id(objj)],objj)])
 
-                if type(objj)!=LTTextBox and\
-                        type(objj)!=LTTextBoxHorizontal:
-                    continue
-                textjj,numjj=findStrFromBox(annoii,objj)
+            #----------------Break if all found----------------
+            anno_found+=numjj
+            if anno_total==anno_found:
+                break
 
-                if numjj>0:
-                    #--------------Attach text with meta--------------
-                    textjj=Anno(textjj,\
-                        ctime=getCtime(anno.highlights[ii+1]),\
-                        title=anno.meta['title'],\
-                        page=ii+1,citationkey=anno.meta['citationkey'],\
-                        tags=anno.meta['tags'])
+        pagetexts[pageno]=textsii
+        if pageno in keys:
+            cache.put(keys[pageno],textsii)
 
-                    hltexts.append(textjj)
-
-                #----------------Break if all found----------------
-                anno_found+=numjj
-                if anno_total==anno_found:
-                    break
-
-
-    return hltexts
+    return attachMeta(anno,pagetexts)
 
 
 
@@ -666,70 +1369,145 @@ def extractHighlights(filename,anno,verbose=True):
 
 
 #----------------Extract highlighted texts from a PDF--------
-def extractHighlights2(filename,anno,verbose=True):
+def extractHighlights2(filename,anno,verbose=True,cache=None,filehash=None,\
+        engine='layout',session=None):
     '''Extract highlighted texts from a PDF
 
     Extract texts from PDF using pdftotext
+
+    <cache>: AnnoCache obj or None. If given together with <filehash>,
+             pages with cached texts are not analyzed, and texts of the
+             other pages are added to the cache.
+    <filehash>: str or None, Files.hash of the PDF.
+    <engine>: str, 'layout' or 'chars', how chars are grouped into text
+              boxes, see ENGINES.
+    <session>: ExtractSession obj or None, resource manager shared with
+               other PDFs.
     '''
 
-    hlpages=anno.hlpages
+    hlpages=set(anno.hlpages)
     if len(hlpages)==0:
         return []
 
+    #---------------Get texts from cache---------------
+    pagetexts,keys=getCachedPages(anno,cache,filehash,\
+            'pdftotext' if engine=='layout' else 'pdftotext-%s' %engine)
+    todo=hlpages.difference(pagetexts)
+
     #--------------Get pdfmine instances--------------
-    document, interpreter, device=init(filename)
+    if len(todo)>0:
+        document, interpreter, device=init(filename,engine,session)
+        pdfwords=PdftotextWords(filename)
+    else:
+        document=None
 
     #----------------Loop through pages----------------
-    hltexts=[]
+    for pageno,page in getPages(document,todo):
 
-    for ii,page in enumerate(PDFPage.create_pages(document)):
+        annoii=anno.highlights[pageno]
+        anno_total=len(annoii)
+        anno_found=0
+        textsii=[]
 
-        #------------Get highlights in page------------
-        if len(hlpages)>0 and ii+1 in hlpages:
+        #------------Merge annos in single line------------
+        annoii=mergeLine(annoii)
 
-            annoii=anno.highlights[ii+1]
-            anno_total=len(annoii)
-            anno_found=0
+        #-----------Sort annotations vertically-----------
+        annoii=sortAnnoY(annoii)
 
-            #------------Merge annos in single line------------
-            annoii=mergeLine(annoii)
+        if engine=='chars':
+            device.rects=[hii['rect'] for hii in annoii]
+        interpreter.process_page(page)
+        layout = device.get_result()
+        if engine=='chars':
+            layout=groupChars(layout)
 
-            #-----------Sort annotations vertically-----------
-            annoii=sortAnnoY(annoii)
+        #--------Sort boxes diagnoally and refine ordering--------
+        pagelayout=PageLayout(layout)
 
-            interpreter.process_page(page)
-            layout = device.get_result()
-            page_height=layout.height
+        #---------Find boxes touched by each highlight---------
+        boxhls=pagelayout.index.groupByBox(annoii)
 
-            #--------------Sort boxes diagnoally--------------
-            objs=sortDiag(layout)
+        #----------------Loop through boxes----------------
+        for jj,objj in enumerate(pagelayout.objs):
 
-            #-----------------Refine ordering-----------------
-            objs=fineTuneOrder(objs)
+            if type(objj)!=LTTextBox and\
+                    type(objj)!=LTTextBoxHorizontal:
+                continue
+            if id(objj) not in boxhls:
+                continue
+            textjj,numjj=findStrFromBox2(boxhls[id(objj)],objj,pdfwords,\
+                    pagelayout)
 
-            #----------------Loop through boxes----------------
-            for jj,objj in enumerate(objs):
+            if numjj>0:
+                textsii.append([textjj,getBoxHighlight(boxhls[id(objj)],objj)])
 
-                if type(objj)!=LTTextBox and\
-                        type(objj)!=LTTextBoxHorizontal:
-                    continue
-                textjj,numjj=findStrFromBox2(annoii,objj,filename,page_height)
+            #----------------Break if all found----------------
+            anno_found+=numjj
+            if anno_total==anno_found:
+                break
+
+        pagetexts[pageno]=textsii
+        if pageno in keys:
+            cache.put(keys[pageno],textsii)
+
+    return attachMeta(anno,pagetexts)
+
+
+
+
+#----------------Get cached texts of highlighted pages----------------
+def getCachedPages(anno,cache,filehash,backend):
+    '''Get cached texts of highlighted pages
+
+    <anno>: FileAnno obj.
+    <cache>: AnnoCache obj or None.
+    <filehash>: str or None, Files.hash of the PDF.
+    <backend>: str, name of the text extraction method.
+
+    Return <pagetexts>: dict, keys: page numbers found in cache, values:
+                        list of [text, rect].
+           <keys>: dict, keys: page numbers not found in cache, values:
+                   cache keys to save their texts with. Empty if no cache.
+    '''
+    pagetexts={}
+    keys={}
+    if cache is None or filehash is None:
+        return pagetexts,keys
+
+    for pp in anno.hlpages:
+        keypp=cache.getKey(filehash,pp,anno.highlights[pp],backend)
+        textspp=cache.get(keypp)
+        if textspp is None:
+            keys[pp]=keypp
+        else:
+            pagetexts[pp]=textspp
+
+    return pagetexts,keys
 
-                if numjj>0:
-                    #--------------Attach text with meta--------------
-                    textjj=Anno(textjj,\
-                        ctime=getCtime(annoii),\
-                        title=anno.meta['title'],\
-                        page=ii+1,citationkey=anno.meta['citationkey'],\
-                        tags=anno.meta['tags'])
 
-                    hltexts.append(textjj)
 
-                #----------------Break if all found----------------
-                anno_found+=numjj
-                if anno_total==anno_found:
-                    break
 
+#----------------Attach meta-data to extracted texts----------------
+def attachMeta(anno,pagetexts):
+    '''Attach meta-data to extracted texts
+
+    <anno>: FileAnno obj.
+    <pagetexts>: dict, keys: page numbers, values: list of
+                 [text, rect].
+
+    Return <hltexts>: list, Anno objs, in page order.
+    '''
+    hltexts=[]
+    for pageno in sorted(pagetexts.keys()):
+        for textjj,rectjj in pagetexts[pageno]:
+            textjj=Anno(textjj,\
+                ctime=getCtime(anno.highlights[pageno]),\
+                title=anno.meta['title'],\
+                page=pageno,citationkey=anno.meta['citationkey'],\
+                tags=anno.meta['tags'],rect=rectjj,\
+                color=getRectColor(anno.highlights[pageno],rectjj))
+            hltexts.append(textjj)
 
     return hltexts
 
@@ -35,10 +35,13 @@ def extractNotes(path,anno,verbose=True):
     for pp in anno.ntpages:
 
         for noteii in notes[pp]:
+            # Side-bar notes have a made-up rect, only to place them in PDFs
+            sidebar=noteii.get('sidebar',False)
             textjj=Anno(noteii['content'], ctime=noteii['cdate'],\
                     title=meta['title'],\
                     page=pp,citationkey=meta['citationkey'], note_author=noteii['author'],\
-                    tags=meta['tags'])
+                    tags=meta['tags'],rect=None if sidebar else noteii['rect'],\
+                    sidebar=sidebar)
             nttexts.append(textjj)
 
     return nttexts
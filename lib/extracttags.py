@@ -10,8 +10,14 @@ Update time: 2016-02-23 23:04:09.
 '''
 
 import os
-from textwrap import TextWrapper
-from tools import printHeader, printInd, printNumHeader
+from tools import printHeader, printInd, printNumHeader, FastTextWrapper
+import outputfiles
+
+
+# Wrappers of annotation texts and of titles. Reused for all annotations,
+# configured once.
+_wrapper=FastTextWrapper(width=70,initial_indent='',subsequent_indent='\t\t')
+_wrapper2=FastTextWrapper(width=60,initial_indent='',subsequent_indent='\t\t\t')
     
 
 
@@ -56,9 +62,12 @@ def groupByTags(annodict,verbose=True):
 
 
 #--------------Export annotations grouped by tags------------------
-def exportAnno(annodict,outdir,action,verbose=True):
+def exportAnno(annodict,outdir,action,verbose=True,outfiles=None):
     '''Export annotations grouped by tags
 
+    <outfiles>: OutputFiles obj or None. If given, write to its writer of
+                the output file, which replaces the file when <outfiles>
+                is closed. Otherwise write the output file directly.
     '''
 
     #-----------Export all to a single file-----------
@@ -70,88 +79,82 @@ def exportAnno(annodict,outdir,action,verbose=True):
         fileout='Mendeley_annotations_by_tags.txt'
 
     abpath_out=os.path.join(outdir,fileout)
-    if os.path.isfile(abpath_out):
+    if outfiles is None and os.path.isfile(abpath_out):
         os.remove(abpath_out)
 
     if verbose:
         printHeader('Exporting all taged annotations to:',3)
         printInd(abpath_out,4)
 
-    conv=lambda x:unicode(x)
+    if outfiles is not None:
+        outfiles.writelines(abpath_out,iterTagTexts(annodict))
+    else:
+        with open(abpath_out, mode='a') as fout:
+            fout.writelines(iterTagTexts(annodict))
 
-    wrapper=TextWrapper()
-    wrapper.width=70
-    wrapper.initial_indent=''
-    #wrapper.subsequent_indent='\t\t'+int(len('> '))*' '
-    wrapper.subsequent_indent='\t\t'
 
-    wrapper2=TextWrapper()
-    wrapper2.width=60
-    wrapper2.initial_indent=''
-    #wrapper2.subsequent_indent='\t\t\t'+int(len('Title: '))*' '
-    wrapper2.subsequent_indent='\t\t\t'
 
-    with open(abpath_out, mode='a') as fout:
+def iterTagTexts(annodict):
+    '''Yield texts of annotations grouped by tags, one tag at a time
 
-        #----------------Loop through tags----------------
-        tags=annodict.keys()
-        if len(tags)==0:
-            return
-        tags.sort()
-        #---------------Put @None at the end---------------
-        if '@None' in tags:
-            tags.remove('@None')
-            tags.append('@None')
-
-        for tagii in tags:
-
-            citedictii=annodict[tagii]
-            outstr=u'''\n\n{0}\n# {1}'''.format(int(80)*'-', conv(tagii))
-            outstr=outstr.encode('ascii','replace')
-            fout.write(outstr)
-
-            #--------------Loop through cite keys--------------
-            for citejj, annosjj in citedictii.items():
-                hljj=annosjj['highlights']
-                ntjj=annosjj['notes']
-
-                outstr=u'''\n\n\t@{0}:'''.format(conv(citejj))
-                outstr=outstr.encode('ascii','replace')
-                fout.write(outstr)
-
-                #-----------------Write highlights-----------------
-                if len(hljj)>0:
-
-                    #-------------Loop through highlights-------------
-                    for hlkk in hljj:
-                        hlstr=wrapper.fill(hlkk.text)
-                        title=wrapper2.fill(hlkk.title)
-                        outstr=u'''
+    Texts of a tag are joined and encoded at once.
+    '''
+
+    conv=lambda x:unicode(x)
+    wrapper=_wrapper
+    wrapper2=_wrapper2
+
+    #----------------Loop through tags----------------
+    tags=annodict.keys()
+    if len(tags)==0:
+        return
+    tags.sort()
+    #---------------Put @None at the end---------------
+    if '@None' in tags:
+        tags.remove('@None')
+        tags.append('@None')
+
+    for tagii in tags:
+
+        citedictii=annodict[tagii]
+        outstr=[u'''\n\n{0}\n# {1}'''.format(int(80)*'-', conv(tagii)),]
+
+        #--------------Loop through cite keys--------------
+        for citejj, annosjj in citedictii.items():
+            hljj=annosjj['highlights']
+            ntjj=annosjj['notes']
+
+            outstr.append(u'''\n\n\t@{0}:'''.format(conv(citejj)))
+
+            #-----------------Write highlights-----------------
+            if len(hljj)>0:
+
+                #-------------Loop through highlights-------------
+                for hlkk in hljj:
+                    hlstr=wrapper.fill(hlkk.text)
+                    title=wrapper2.fill(hlkk.title)
+                    outstr.append(u'''
 \n\t\t> {0}
 
 \t\t\t- Title: {1}
 \t\t\t- Ctime: {2}'''.format(*map(conv,[hlstr, title,\
-                      hlkk.ctime]))
-
-                        outstr=outstr.encode('ascii','replace')
-                        fout.write(outstr)
+                  hlkk.ctime])))
 
-                #-----------------Write notes-----------------
-                if len(ntjj)>0:
+            #-----------------Write notes-----------------
+            if len(ntjj)>0:
 
-                    #----------------Loop through notes----------------
-                    for ntkk in ntjj:
-                        ntstr=wrapper.fill(ntkk.text)
-                        title=wrapper2.fill(ntkk.title)
-                        outstr=u'''
+                #----------------Loop through notes----------------
+                for ntkk in ntjj:
+                    ntstr=wrapper.fill(ntkk.text)
+                    title=wrapper2.fill(ntkk.title)
+                    outstr.append(u'''
 \n\t\t- {0}
 
 \t\t\t- Title: {1}
 \t\t\t- Ctime: {2}'''.format(*map(conv,[ntstr, title,\
-                    ntkk.ctime]))
+                ntkk.ctime])))
 
-                        outstr=outstr.encode('ascii','replace')
-                        fout.write(outstr)
+        yield u''.join(outstr).encode('ascii','replace')
 
         
 
@@ -0,0 +1,130 @@
+'''Buffered output files kept open for a whole export run.
+
+
+# Copyright 2016 Guang-zhi XU
+#
+# This file is distributed under the terms of the
+# GPLv3 licence. See the LICENSE file for details.
+# You may use, distribute and modify this code under the
+# terms of the GPLv3 license.
+'''
+
+import os
+import tempfile
+from collections import OrderedDict
+
+
+# Buffer size of each output file, in bytes
+BUFSIZE=256*1024
+
+# Max number of files open at a time
+MAXOPEN=32
+
+
+
+#---------------Output files written via temp files---------------
+class OutputFiles(object):
+
+    def __init__(self,bufsize=BUFSIZE,maxopen=MAXOPEN):
+        '''Obj to hold one buffered writer per output file.
+
+        <bufsize>: int, buffer size of each output file.
+        <maxopen>: int, max number of files open at a time. The least
+                   recently written file is closed to keep below, and
+                   reopened in append mode on its next write.
+
+        A file is opened at its first get() or write(), and stays open
+        for later writes to the same path, e.g. from other folders when
+        they share a .bib file.
+
+        By default, a file is written as a temp file in the same folder.
+        close() renames all temp files to their paths, replacing the
+        files of earlier runs, and abort() drops them instead. A file got
+        with atomic=False is appended to at its path directly.
+        '''
+        self.bufsize=bufsize
+        self.maxopen=maxopen
+        # keys: abspath, values: [file obj or None, path written to, atomic]
+        self.files={}
+        self.opened=OrderedDict()
+
+        # mkstemp() creates files readable by the user only, outputs get
+        # the default mode instead
+        umask=os.umask(0)
+        os.umask(umask)
+        self.mode=0o666 & ~umask
+
+    def __contains__(self,path):
+        return os.path.abspath(path) in self.files
+
+    def get(self,path,atomic=True):
+        '''Get the writer of an output file, open it if not yet
+
+        <path>: str, path to the output file.
+        <atomic>: bool, at the first get() of <path>, whether to write
+                  to a temp file renamed by close(), or to <path> directly.
+        '''
+        path=os.path.abspath(path)
+        entry=self.files.get(path)
+
+        if entry is None:
+            folder,filename=os.path.split(path)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            if atomic:
+                fd,tmpname=tempfile.mkstemp(prefix='.%s.' %filename,\
+                        suffix='.tmp',dir=folder)
+                fout=os.fdopen(fd,'w',self.bufsize)
+            else:
+                tmpname=path
+                fout=open(path,'a',self.bufsize)
+            entry=[fout,tmpname,atomic]
+            self.files[path]=entry
+
+        elif entry[0] is None:
+            entry[0]=open(entry[1],'a',self.bufsize)
+
+        #--------------Close least recently used--------------
+        self.opened.pop(path,None)
+        self.opened[path]=entry
+        while len(self.opened)>self.maxopen:
+            entry_old=self.opened.popitem(last=False)[1]
+            entry_old[0].close()
+            entry_old[0]=None
+
+        return entry[0]
+
+    def write(self,path,data,atomic=True):
+        self.get(path,atomic).write(data)
+
+    def writelines(self,path,lines,atomic=True):
+        '''Write strs from an iterable, e.g. a generator of entries
+        '''
+        self.get(path,atomic).writelines(lines)
+
+    def close(self):
+        '''Finish all output files, moving temp files to their paths
+        '''
+        for path,(fout,tmpname,atomic) in self.files.items():
+            if fout is not None:
+                fout.close()
+            if not atomic:
+                continue
+            os.chmod(tmpname,self.mode)
+            if os.name=='nt' and os.path.isfile(path):
+                os.remove(path)
+            os.rename(tmpname,path)
+        self.files={}
+        self.opened.clear()
+
+    def abort(self):
+        '''Drop all temp files, leaving their paths untouched
+        '''
+        for path,(fout,tmpname,atomic) in self.files.items():
+            if fout is not None:
+                fout.close()
+            if atomic and os.path.exists(tmpname):
+                os.remove(tmpname)
+        self.files={}
+        self.opened.clear()
+
@@ -15,8 +15,11 @@ Update time: 2016-02-19 14:33:33.
 
 
 
+import shutil
+from io import BytesIO
 from datetime import datetime
 from PyPDF2.generic import *
+from PyPDF2.utils import b_
 
 
 
@@ -228,3 +231,136 @@ def addAnnotation(page, outpdf, anno):
 
 
 
+
+
+
+def findStartxref(stream):
+    '''Get the offset of the last xref section, and the size of a PDF.'''
+
+    stream.seek(0, 2)
+    size = stream.tell()
+    stream.seek(max(0, size-1024))
+    tail = stream.read()
+    idx = tail.rfind(b_('startxref'))
+    if idx<0:
+        raise Exception("startxref not found")
+    return int(tail[idx+9:].split()[0]), size
+
+
+def canAppendXref(inpdf):
+    '''Check if an xref table can be appended to a PDF.
+
+    <inpdf>: PyPDF2.PdfFileReader obj.
+
+    An appended xref table has to follow a previous xref table. Files
+    whose last xref section is a cross-reference stream (PDF 1.5+) can't
+    be updated with one.
+    '''
+    try:
+        prev, size = findStartxref(inpdf.stream)
+        inpdf.stream.seek(prev)
+        head = inpdf.stream.read(32)
+    except Exception:
+        return False
+    return head.lstrip().startswith(b_('xref'))
+
+
+class IncrementalWriter(object):
+
+    def __init__(self, inpdf):
+        '''Writer of an incremental update to an existing PDF.
+
+        <inpdf>: PyPDF2.PdfFileReader obj of a not encrypted PDF, with
+                 an xref table, see canAppendXref().
+
+        Instead of re-serializing the whole document like PdfFileWriter,
+        write() copies the bytes of the original file as they are, and
+        appends only the new objs, the modified page dictionaries and a
+        new xref section (see "Incremental Updates" in the PDF spec).
+
+        Can be passed to addAnnotation() in place of a PdfFileWriter.
+        '''
+
+        self.inpdf = inpdf
+        if '/Size' in inpdf.trailer:
+            self.size = inpdf.trailer['/Size']
+        else:
+            # Not copied from xref streams by some PyPDF2 versions
+            idnums = list(inpdf.xref_objStm.keys())
+            for objs in inpdf.xref.values():
+                idnums.extend(objs.keys())
+            self.size = max(idnums)+1
+        self._objects = {}
+        self._pages = []
+
+    def _addObject(self, obj):
+        '''Add a new obj, return an IndirectObject to it.'''
+
+        idnum = self.size + len(self._objects)
+        self._objects[idnum] = obj
+        return IndirectObject(idnum, 0, self)
+
+    def getObject(self, ido):
+        if ido.idnum in self._objects:
+            return self._objects[ido.idnum]
+        return self.inpdf.getObject(ido)
+
+    def updatePage(self, page):
+        '''Mark a page (PageObject of <inpdf>) as modified.'''
+
+        if page.indirectRef is None:
+            raise Exception("Page is not an indirect object")
+        self._pages.append(page)
+
+    def write(self, stream):
+        '''Write the original PDF followed by the update to <stream>.'''
+
+        prev, size = findStartxref(self.inpdf.stream)
+
+        #--------------Objs modified or added--------------
+        objs = {}
+        for page in self._pages:
+            ref = page.indirectRef
+            objs[ref.idnum] = (ref.generation, page)
+            # addAnnotation() appends to an indirect /Annots array in place
+            annots = page.raw_get('/Annots')
+            if isinstance(annots, IndirectObject):
+                objs[annots.idnum] = (annots.generation, annots.getObject())
+        for idnum, obj in self._objects.items():
+            objs[idnum] = (0, obj)
+
+        #-------------Copy original bytes as is-------------
+        self.inpdf.stream.seek(0)
+        shutil.copyfileobj(self.inpdf.stream, stream)
+
+        #-------------------Append objs-------------------
+        update = BytesIO()
+        update.write(b_('\n'))
+        offsets = []
+        for idnum in sorted(objs.keys()):
+            generation, obj = objs[idnum]
+            offsets.append((idnum, generation, size+update.tell()))
+            update.write(b_('%d %d obj\n' %(idnum, generation)))
+            obj.writeToStream(update, None)
+            update.write(b_('\nendobj\n'))
+
+        #--------------------New xref--------------------
+        startxref = size+update.tell()
+        update.write(b_('xref\n0 1\n0000000000 65535 f \n'))
+        for idnum, generation, offset in offsets:
+            update.write(b_('%d 1\n%010d %05d n \n' %(idnum, offset, generation)))
+
+        trailer = DictionaryObject({\
+                NameObject('/Size'): NumberObject(self.size+len(self._objects)),\
+                NameObject('/Root'): self.inpdf.trailer.raw_get('/Root'),\
+                NameObject('/Prev'): NumberObject(prev),\
+                })
+        for key in ['/Info', '/ID']:
+            if key in self.inpdf.trailer:
+                trailer[NameObject(key)] = self.inpdf.trailer.raw_get(key)
+
+        update.write(b_('trailer\n'))
+        trailer.writeToStream(update, None)
+        update.write(b_('\nstartxref\n%d\n%%%%EOF\n' %startxref))
+
+        stream.write(update.getvalue())
@@ -26,6 +26,7 @@
 
 import unicodedata;
 import logging
+import re
 
 log = logging.getLogger(__name__)
 
@@ -812,42 +813,73 @@ utf82latex={
 # ------------------------------------------------------------------------------------------------
 
 
-
-
-
+# Replacements of chars, as unicode, with and without brackets around macros
+_encode_tables = {}
+
+def _get_encode_table(brackets):
+    table = _encode_tables.get(brackets)
+    if table is None:
+        table = {}
+        for (code, lch) in utf82latex.iteritems():
+            lch = unicode(lch)
+            # add brackets if needed, i.e. if we have a substituting macro.
+            # note: in condition, beware, that lch might be of zero length.
+            table[unichr(code)] = (  u'{'+lch+u'}' if brackets and lch[0:1] == u'\\' else
+                                     lch  )
+        _encode_tables[brackets] = table
+    return table
+
+# Chars that may need to be replaced: all but ordinary printable ascii chars
+# (or all but ascii chars if non_ascii_only) without an entry in utf82latex.
+# Runs of other chars are skipped by a single regex scan.
+_safe_ascii = u''.join(unichr(c) for c in range(32, 128) if c not in utf82latex) + u'\n\r\t'
+_special_rx = {
+    False: re.compile(u'[^' + re.escape(_safe_ascii) + u']', re.UNICODE),
+    True: re.compile(u'[^\\x00-\\x7f]', re.UNICODE),
+    }
+
+# Cache of encoded short strings, such as tags, journal names and authors
+_cache = {}
+_CACHE_MAX_LEN = 256
+_CACHE_MAX_ENTRIES = 20000
 
 
 def utf8tolatex(s, non_ascii_only=False, brackets=True, substitute_bad_chars=False):
     s = unicode(s); # make sure s is unicode
-    s = unicodedata.normalize('NFC', s);
 
     if not s:
         return ""
 
-    result = u""
-    for ch in s:
-        #log.longdebug("Encoding char %r", ch)
-        if (non_ascii_only and ord(ch) < 127):
-            result += ch
-        else:
-            lch = utf82latex.get(ord(ch), None)
-            if (lch is not None):
-                # add brackets if needed, i.e. if we have a substituting macro.
-                # note: in condition, beware, that lch might be of zero length.
-                result += (  '{'+lch+'}' if brackets and lch[0:1] == '\\' else
-                             lch  )
-            elif ((ord(ch) >= 32 and ord(ch) <= 127) or
-                  (ch in "\n\r\t")):
-                # ordinary printable ascii char, just add it
-                result += ch
-            else:
-                # non-ascii char
-                log.warning(u"Character cannot be encoded into LaTeX: U+%04X - `%s'" % (ord(ch), ch))
-                if (substitute_bad_chars):
-                    result += r'{\bfseries ?}'
-                else:
-                    # keep unescaped char
-                    result += ch
+    key = (s, non_ascii_only, brackets, substitute_bad_chars)
+    result = _cache.get(key)
+    if result is not None:
+        return result
+
+    s = unicodedata.normalize('NFC', s);
+
+    table = _get_encode_table(bool(brackets))
+    bad = []
+
+    def replace(m):
+        ch = m.group()
+        lch = table.get(ch)
+        if lch is not None:
+            return lch
+        # non-ascii char
+        log.warning(u"Character cannot be encoded into LaTeX: U+%04X - `%s'" % (ord(ch), ch))
+        bad.append(ch)
+        if (substitute_bad_chars):
+            return r'{\bfseries ?}'
+        # keep unescaped char
+        return ch
+
+    result = _special_rx[bool(non_ascii_only)].sub(replace, s)
+
+    # don't cache strings with bad chars, so the warning is logged each time
+    if len(key[0]) <= _CACHE_MAX_LEN and not bad:
+        if len(_cache) >= _CACHE_MAX_ENTRIES:
+            _cache.clear()
+        _cache[key] = result
 
     return result
 
@@ -862,8 +894,51 @@ def utf8tolatex(s, non_ascii_only=False, brackets=True, substitute_bad_chars=Fal
 
 
 
+
+def _benchmark(argv):
+    """
+    Time utf8tolatex() on the lines of a utf-8 text file, e.g. exported
+    highlights or bibtex fields: with the result cache emptied before each
+    pass, and with it kept.
+
+    Usage: python latexencode.py --bench corpus.txt [number]
+    """
+    import io
+    import timeit
+
+    if len(argv) < 1:
+        print _benchmark.__doc__
+        return 1
+
+    with io.open(argv[0], 'r', encoding='utf8') as fin:
+        corpus = fin.read().splitlines()
+    number = int(argv[1]) if len(argv) > 1 else 20
+
+    # don't time the warnings for chars with no LaTeX encoding
+    log.setLevel(logging.ERROR)
+
+    def run():
+        for line in corpus:
+            utf8tolatex(line)
+
+    def run_uncached():
+        _cache.clear()
+        run()
+
+    print '%d lines, %d chars' % (len(corpus), sum(map(len, corpus)))
+    for (label, func) in [('uncached', run_uncached), ('cached', run)]:
+        seconds = min(timeit.repeat(func, number=number, repeat=3)) / number
+        print '%s: %.2f ms per pass' % (label, seconds*1e3)
+    return 0
+
+
 if __name__ == '__main__':
 
+    import sys
+
+    if sys.argv[1:2] == ['--bench']:
+        sys.exit(_benchmark(sys.argv[2:]))
+
     try:
 
         # create console handler and set level to debug
@@ -33,8 +33,7 @@ import tkMessageBox
 import menotexport
 import Queue
 import threading
-import sqlite3
-import pandas as pd
+import multiprocessing
 if sys.version_info[0]>=3:
     import tkinter as tk
     from tkinter import Frame
@@ -223,11 +222,12 @@ C:\Users\Your_name\AppData\Local\Mendeley Ltd\Mendeley Desktop\your_email@www.me
     def probeFolders(self):
         dbfile=self.db_entry.get()
         try:
-            db=sqlite3.connect(dbfile)
+            db=menotexport.connectDb(dbfile)
             self.menfolderlist=menotexport.getFolderList(db,None)   #(id, name)
             self.foldernames=['All']+[ii[1] for ii in self.menfolderlist] #names to display
             self.foldersmenu['values']=tuple(self.foldernames)
             self.foldersmenu.current(0)
+            menotexport.clearDbCache(db)
             db.close()
 
             self.hasdb=True
@@ -259,6 +259,7 @@ C:\Users\Your_name\AppData\Local\Mendeley Ltd\Mendeley Desktop\your_email@www.me
         self.isris=tk.IntVar()
         self.isseparate=tk.IntVar()
         self.iszotero=tk.IntVar()
+        self.isincremental=tk.IntVar()
 
         self.check_export=tk.Checkbutton(frame,text='Export PDFs',\
                 variable=self.isexport,command=self.doExport)
@@ -289,6 +290,11 @@ C:\Users\Your_name\AppData\Local\Mendeley Ltd\Mendeley Desktop\your_email@www.me
                 variable=self.iszotero,command=self.doIszotero,\
                 state=tk.DISABLED)
 
+        self.check_incremental=tk.Checkbutton(frame,\
+                text='Skip unchanged PDFs',\
+                variable=self.isincremental,command=self.doIncremental,\
+                state=tk.DISABLED)
+
         frame.columnconfigure(0,weight=1)
 
         self.check_export.grid(row=0,column=1,padx=8,sticky=tk.W)
@@ -298,6 +304,7 @@ C:\Users\Your_name\AppData\Local\Mendeley Ltd\Mendeley Desktop\your_email@www.me
         self.check_ris.grid(row=1,column=1,padx=8,sticky=tk.W)
         self.check_separate.grid(row=1,column=2,padx=8,sticky=tk.W)
         self.check_iszotero.grid(row=1,column=3,padx=8,sticky=tk.W)
+        self.check_incremental.grid(row=1,column=4,padx=8,sticky=tk.W)
 
         #---------------------2nd row---------------------
         subframe=Frame(frame)
@@ -316,6 +323,27 @@ C:\Users\Your_name\AppData\Local\Mendeley Ltd\Mendeley Desktop\your_email@www.me
         self.foldersmenu.current(0)
         self.foldersmenu.bind('<<ComboboxSelected>>',self.setfolder)
         self.foldersmenu.pack(side=tk.LEFT,padx=8)
+
+        #-------------------Number of processes-------------------
+        jobslabel=tk.Label(subframe,text='Processes:',\
+                bg='#bbb')
+        jobslabel.pack(side=tk.LEFT, padx=8)
+
+        self.jobs_spin=tk.Spinbox(subframe,from_=1,\
+                to=multiprocessing.cpu_count(),width=3,state='readonly')
+        self.jobs_spin.pack(side=tk.LEFT,padx=8)
+
+        #---------------Copy mode of un-annotated PDFs---------------
+        linklabel=tk.Label(subframe,text='Copy PDFs as:',\
+                bg='#bbb')
+        linklabel.pack(side=tk.LEFT, padx=8)
+
+        self.linkmodes=[('copy',None),('reflink','reflink'),\
+                ('hard link','hard')]
+        self.linkmenu=Combobox(subframe,values=[ii[0] for ii in\
+                self.linkmodes],state='readonly',width=9)
+        self.linkmenu.current(0)
+        self.linkmenu.pack(side=tk.LEFT,padx=8)
         
         #-------------------Quit button-------------------
         quit_button=tk.Button(subframe,text='Quit',\
@@ -355,8 +383,10 @@ C:\Users\Your_name\AppData\Local\Mendeley Ltd\Mendeley Desktop\your_email@www.me
     def doExport(self):
         if self.isexport.get()==1:
             print('# <Menotexport>: Export annotated PDFs.')
+            self.check_incremental.configure(state=tk.NORMAL)
         else:
             print('# <Menotexport>: Dont export annotated PDFs.')
+            self.check_incremental.configure(state=tk.DISABLED)
 
         self.checkReady()
 
@@ -415,6 +445,12 @@ C:\Users\Your_name\AppData\Local\Mendeley Ltd\Mendeley Desktop\your_email@www.me
         else:
             print('# <Menotexport>: Save .bib/.ris file to default format.')
 
+    def doIncremental(self):
+        if self.isincremental.get()==1:
+            print('# <Menotexport>: Skip PDFs unchanged since last export.')
+        else:
+            print('# <Menotexport>: Export all PDFs.')
+
 
 
     def showHelp(self):
@@ -427,6 +463,9 @@ C:\Users\Your_name\AppData\Local\Mendeley Ltd\Mendeley Desktop\your_email@www.me
 - Export .ris: Export meta-data and annotations to .ris files.\n
 - For import to Zotero: Exported .bib and/or .ris files have suitable format to import to Zotero.\n
 - Save separately: If on, save each PDF's annotations to a separate txt.\n
+- Skip unchanged PDFs: Skip PDFs whose file, highlights and notes are unchanged since the last export to the same output folder.\n
+- Copy PDFs as: Export un-annotated PDFs as copies, copy-on-write clones (reflinks) or hard links of the Mendeley files. Falls back to copies if a link can't be made. Hard links share contents with the Mendeley files.\n
+- Processes: Number of processes to extract highlights and notes, and to export annotated PDFs with.\n
 - See README.md for more info.\n
 ''' %self.title
 
@@ -465,6 +504,15 @@ C:\Users\Your_name\AppData\Local\Mendeley Ltd\Mendeley Desktop\your_email@www.me
             iszotero=True
         else:
             iszotero=False
+        if self.isincremental.get()==1:
+            incremental=True
+        else:
+            incremental=False
+        try:
+            jobs=int(self.jobs_spin.get())
+        except:
+            jobs=1
+        link=dict(self.linkmodes).get(self.linkmenu.get())
 
             
         if 'p' in action or 'm' in action or 'n' in action or 'b' in action or 'r' in action:
@@ -480,11 +528,15 @@ C:\Users\Your_name\AppData\Local\Mendeley Ltd\Mendeley Desktop\your_email@www.me
             self.check_ris.configure(state=tk.DISABLED)
             self.check_separate.configure(state=tk.DISABLED)
             self.check_iszotero.configure(state=tk.DISABLED)
+            self.check_incremental.configure(state=tk.DISABLED)
+            self.jobs_spin.configure(state=tk.DISABLED)
+            self.linkmenu.configure(state=tk.DISABLED)
 	    self.messagelabel.configure(text='Message (working...)')
 
             folder=None if self.menfolder=='All' else folder_sel
 
-            args=[dbfile,outdir,action,folder,separate,iszotero,True]
+            args=[dbfile,outdir,action,folder,separate,iszotero,True,jobs,\
+                    incremental,link]
 
             self.workthread=WorkThread('work',False,self.stateq)
             self.workthread.deamon=True
@@ -516,6 +568,9 @@ C:\Users\Your_name\AppData\Local\Mendeley Ltd\Mendeley Desktop\your_email@www.me
                     self.check_bib.configure(state=tk.NORMAL)
                     self.check_separate.configure(state=tk.NORMAL)
                     self.check_iszotero.configure(state=tk.NORMAL)
+                    self.check_incremental.configure(state=tk.NORMAL)
+                    self.jobs_spin.configure(state='readonly')
+                    self.linkmenu.configure(state='readonly')
                     self.messagelabel.configure(text='Message')
                     return
             except Queue.Empty:
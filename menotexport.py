@@ -25,13 +25,17 @@ __version__='Menotexport v1.4'
 import sys,os
 import sqlite3
 import argparse
-import pandas as pd
+import multiprocessing
 from lib import extracttags
 from lib import extractnt
 from lib import exportpdf
 from lib import exportannotation
 from lib import export2bib
 from lib import export2ris
+from lib import export2table
+from lib import exportmanifest
+from lib import annocache
+from lib import outputfiles
 from lib.tools import printHeader, printInd, printNumHeader
 #from html2text import html2text
 from bs4 import BeautifulSoup
@@ -41,14 +45,150 @@ if sys.version_info[0]>=3:
     #---------------------Python3---------------------
     from urllib.parse import unquote
     from urllib.parse import urlparse
+    from urllib.request import pathname2url
 else:
     #--------------------Python2.7--------------------
     from urllib import unquote
     from urlparse import urlparse
+    from urllib import pathname2url
 
 
-#-------Fetch a column from pandas dataframe-------
-fetchField=lambda x, f: x[f].unique().tolist()
+#-------Pragmas of connections to Mendeley database-------
+# Page cache of 64 MB (negative values are in KB), memory-mapped reads
+# of up to 256 MB, and temp tables and indices of sorts kept in memory.
+DB_PRAGMAS=['cache_size=-65536',\
+            'mmap_size=268435456',\
+            'temp_store=MEMORY']
+
+
+def connectDb(dbfin,immutable=False):
+    '''Open a read-only connection to Mendeley database
+
+    <dbfin>: str, path to the Mendeley sqlite database file.
+    <immutable>: bool, if True, also open with immutable=1. sqlite then
+                 takes no locks at all and never checks for changes by
+                 others, so this is only safe if Mendeley Desktop is not
+                 writing to the database during the run.
+
+    The database is opened by a file: URI with mode=ro, so the export
+    never takes write locks, and reads only take shared locks. If the URI
+    can't be opened, e.g. by a python2 sqlite3 built without URI support,
+    fall back to a plain connection with query_only set.
+    '''
+
+    path=os.path.abspath(dbfin)
+    if not os.path.isfile(path):
+        raise Exception('Database file not found: %s' %path)
+
+    if sys.version_info[0]<3 and isinstance(path,unicode):
+        urlpath=pathname2url(path.encode('utf8'))
+    else:
+        urlpath=pathname2url(path)
+    uri='file:%s?mode=ro' %urlpath
+    if immutable:
+        uri+='&immutable=1'
+
+    #------------Open by URI, or fall back------------
+    try:
+        if sys.version_info[0]>=3:
+            db=sqlite3.connect(uri,uri=True)
+        else:
+            db=sqlite3.connect(uri)
+        # Fails here if the file can't be read as a database
+        db.execute('PRAGMA schema_version').fetchone()
+    except sqlite3.Error:
+        db=sqlite3.connect(path)
+        db.execute('PRAGMA query_only=ON')
+
+    for pragmaii in DB_PRAGMAS:
+        db.execute('PRAGMA %s' %pragmaii)
+
+    return db
+
+
+#-------Row access to sqlite3 query results-------
+def _columnIndex(cursor,field):
+    '''Get index of column <field> in the results of <cursor>
+
+    <field>: int, column index, or str, column name as in the query
+             without the table prefix, e.g. 'id' for Documents.id.
+    '''
+    if isinstance(field,int):
+        return field
+    names=[ii[0].lower() for ii in cursor.description]
+    return names.index(field.lower())
+
+
+def fetchField(cursor,field):
+    '''Fetch unique values of a column, in order of appearance
+
+    <cursor>: sqlite3.Cursor, as returned by db.execute(). Rows are
+              streamed from it, not copied.
+    <field>: int or str, column index or name, see _columnIndex().
+    '''
+    idx=_columnIndex(cursor,field)
+    seen=set()
+    result=[]
+    for r in cursor:
+        if r[idx] not in seen:
+            seen.add(r[idx])
+            result.append(r[idx])
+    return result
+
+
+def groupField(cursor,keyfield,field):
+    '''Group unique values of a column by another, in order of appearance
+
+    <cursor>: sqlite3.Cursor, as returned by db.execute().
+    <keyfield>: int or str, column to group by.
+    <field>: int or str, column to collect. If a list of columns, collect
+             tuples of their values.
+
+    Return <result>: dict, keys: values of <keyfield>, values: lists of
+                     unique values of <field>.
+    '''
+    kidx=_columnIndex(cursor,keyfield)
+    if isinstance(field,(list,tuple)):
+        idxs=[_columnIndex(cursor,ff) for ff in field]
+        getValue=lambda r: tuple([r[ii] for ii in idxs])
+    else:
+        idx=_columnIndex(cursor,field)
+        getValue=lambda r: r[idx]
+
+    result={}
+    seen=set()
+    for r in cursor:
+        key=r[kidx]
+        value=getValue(r)
+        if (key,value) not in seen:
+            seen.add((key,value))
+            result.setdefault(key,[]).append(value)
+    return result
+
+
+#-------Per-connection caches of whole-library lookups-------
+_db_caches={}
+
+def getDbCache(db,cls):
+    '''Get a lookup obj of class <cls> built from <db>
+
+    <db>: sqlite3.connection to Mendeley sqlite database.
+    <cls>: class whose constructor takes <db> and reads all it needs
+           from the database in one go.
+
+    The obj is built on the 1st call, and reused by later calls
+    on the same connection. Call clearDbCache() before closing <db>.
+    '''
+    caches=_db_caches.setdefault(db,{})
+    if cls not in caches:
+        caches[cls]=cls(db)
+    return caches[cls]
+
+
+def clearDbCache(db):
+    '''Drop all lookup objs built from <db>
+    '''
+    _db_caches.pop(db,None)
 
 
 
@@ -122,11 +262,10 @@ def converturl2abspath(url):
             return path
 
 
-def getMetaData(db, docid):
-    '''Get meta-data of a doc by documentId.
-    '''
+class MetaCatalog(object):
 
-    query=\
+    # Columns of the Documents table, in the order of <fields> below.
+    doc_query=\
     '''SELECT Documents.id,
               Documents.citationkey,
               Documents.title,
@@ -151,44 +290,76 @@ def getMetaData(db, docid):
               Documents.series,
               Documents.type,
               Documents.read,
-              Documents.favourite,
-              DocumentTags.tag,
-              DocumentContributors.firstNames,
-              DocumentContributors.lastName,
-              DocumentKeywords.keyword
+              Documents.favourite
        FROM Documents
-       LEFT JOIN DocumentTags
-           ON DocumentTags.documentId=Documents.id
-       LEFT JOIN DocumentContributors
-           ON DocumentContributors.documentId=Documents.id
-       LEFT JOIN DocumentKeywords
-           ON DocumentKeywords.documentId=Documents.id
     '''
 
-    #------------------Get file meta data------------------
-    ret=db.execute(query)
-    data=ret.fetchall()
     fields=['docid','citationkey','title','issue','pages',\
             'publication','volume','year','doi','abstract',\
             'arxivId','chapter','city','country','edition','institution',\
             'isbn','issn','month','day','publisher','series','type',\
             'read','favourite','tags','firstnames','lastname','keywords']
 
-    df=pd.DataFrame(data=data,columns=fields)
-    docdata=df[df.docid==docid]
-    result={}
-    for ff in fields:
-        fieldii=fetchField(docdata,ff)
-        result[ff]=fieldii[0] if len(fieldii)==1 else fieldii
+    def __init__(self,db):
+        '''Obj to hold meta-data of all documents, indexed by documentId.
 
-    return result
+        <db>: sqlite3.connection to Mendeley sqlite database.
 
+        Documents, tags, contributors and keywords are each read in a
+        single query, so the cost is linear in library size.
+        '''
 
-#---------------Get file path of a PDF using documentId---------------
-def getFilePath(db,docid,verbose=True):
-    '''Get file path of a PDF using documentId
+        #------------------Get document fields------------------
+        self.docs={}
+        for r in db.execute(self.doc_query):
+            self.docs[r[0]]=r
+
+        #-------------Get multi-valued fields-------------
+        self.tags=groupField(db.execute(\
+            '''SELECT documentId, tag FROM DocumentTags'''),\
+            'documentId','tag')
+        self.firstnames=groupField(db.execute(\
+            '''SELECT documentId, firstNames FROM DocumentContributors'''),\
+            'documentId','firstNames')
+        self.lastnames=groupField(db.execute(\
+            '''SELECT documentId, lastName FROM DocumentContributors'''),\
+            'documentId','lastName')
+        self.keywords=groupField(db.execute(\
+            '''SELECT documentId, keyword FROM DocumentKeywords'''),\
+            'documentId','keyword')
+
+    def getMeta(self,docid):
+        '''Get meta-data of a doc by documentId.
+
+        Return <result>: dict, keys are <fields>. A field with a single
+                         value is given as is, with multiple values as
+                         a list (None if doc has no such entry).
+        '''
+
+        if docid not in self.docs:
+            return dict([(ff,[]) for ff in self.fields])
+
+        result=dict(zip(self.fields,self.docs[docid]))
+        for ff,lookup in [('tags',self.tags),('firstnames',self.firstnames),\
+                ('lastname',self.lastnames),('keywords',self.keywords)]:
+            # Return a copy as callers modify the lists in place.
+            fieldii=list(lookup.get(docid,[None,]))
+            result[ff]=fieldii[0] if len(fieldii)==1 else fieldii
+
+        return result
+
+
+def getMetaData(db, docid):
+    '''Get meta-data of a doc by documentId.
+
+    Served from the MetaCatalog of <db>, which is loaded on the 1st call.
     '''
 
+    return getDbCache(db,MetaCatalog).getMeta(docid)
+
+
+class PathResolver(object):
+
     query=\
     '''SELECT Files.localUrl, 
               DocumentFiles.hash,
@@ -200,21 +371,184 @@ def getFilePath(db,docid,verbose=True):
            ON Documents.id=DocumentFiles.documentId
     '''
 
-    ret=db.execute(query)
-    data=ret.fetchall()
-    df=pd.DataFrame(data=data,columns=['url','hash','docid'])
+    def __init__(self,db):
+        '''Obj to map documentId to (file hash, localUrl, abspath).
 
-    #-----------------Search file path-----------------
-    pathdata=df[df.docid==docid]
-    if len(pathdata)==0:
-        return None
-    else:
-        url=fetchField(pathdata,'url')[0]
-        pth = converturl2abspath(url)
-        return pth
+        <db>: sqlite3.connection to Mendeley sqlite database.
+
+        All files are read in a single query. Url to abspath conversions
+        are done on demand and memoized.
+        '''
+
+        self._abspaths={}
+
+        # Keep the 1st file of a doc, same as before.
+        files=groupField(db.execute(self.query),'id',['hash','localUrl'])
+        files.pop(None,None)
+        self.files=dict([(kk,vv[0]) for kk,vv in files.items()])
+
+    def resolveUrl(self,url):
+        '''Memoized converturl2abspath()
+        '''
+        if url not in self._abspaths:
+            self._abspaths[url]=converturl2abspath(url)
+        return self._abspaths[url]
+
+    def getFile(self,docid):
+        '''Get (hash, localUrl, abspath) of a doc, None if doc has no file.
+        '''
+        if docid not in self.files:
+            return None
+        hashii,url=self.files[docid]
+        return hashii,url,self.resolveUrl(url)
+
+    def getPath(self,docid):
+        '''Get abspath of the file of a doc, None if doc has no file.
+        '''
+        if docid not in self.files:
+            return None
+        return self.resolveUrl(self.files[docid][1])
+
+    def getHash(self,docid):
+        '''Get file hash of a doc, None if doc has no file.
+        '''
+        if docid not in self.files:
+            return None
+        return self.files[docid][0]
 
 
-def getHighlights(db,results=None,folderid=None,foldername=None,filterdocid=None):
+#---------------Get file path of a PDF using documentId---------------
+def getFilePath(db,docid,verbose=True):
+    '''Get file path of a PDF using documentId
+
+    Served from the PathResolver of <db>, which is loaded on the 1st call.
+    '''
+
+    return getDbCache(db,PathResolver).getPath(docid)
+
+
+#-----Annotation queries with folder info, run per folder or all at once-----
+HIGHLIGHT_QUERY=\
+'''SELECT Files.localUrl, FileHighlightRects.page,
+                FileHighlightRects.x1, FileHighlightRects.y1,
+                FileHighlightRects.x2, FileHighlightRects.y2,
+                FileHighlights.createdTime,
+                FileHighlights.documentId,
+                DocumentFolders.folderid,
+                Folders.name,
+                FileHighlights.color
+        FROM Files
+        LEFT JOIN FileHighlights
+            ON FileHighlights.fileHash=Files.hash
+        LEFT JOIN FileHighlightRects
+            ON FileHighlightRects.highlightId=FileHighlights.id
+        LEFT JOIN DocumentFolders
+            ON DocumentFolders.documentId=FileHighlights.documentId
+        LEFT JOIN Folders
+            ON Folders.id=DocumentFolders.folderid
+        WHERE (FileHighlightRects.page IS NOT NULL)
+'''
+
+HIGHLIGHT_QUERY_OLD=\
+'''SELECT Files.localUrl, FileHighlightRects.page,
+                FileHighlightRects.x1, FileHighlightRects.y1,
+                FileHighlightRects.x2, FileHighlightRects.y2,
+                FileHighlights.createdTime,
+                FileHighlights.documentId,
+                DocumentFolders.folderid,
+                Folders.name
+        FROM Files
+        LEFT JOIN FileHighlights
+            ON FileHighlights.fileHash=Files.hash
+        LEFT JOIN FileHighlightRects
+            ON FileHighlightRects.highlightId=FileHighlights.id
+        LEFT JOIN DocumentFolders
+            ON DocumentFolders.documentId=FileHighlights.documentId
+        LEFT JOIN Folders
+            ON Folders.id=DocumentFolders.folderid
+        WHERE (FileHighlightRects.page IS NOT NULL)
+'''
+
+NOTE_QUERY=\
+'''SELECT Files.localUrl, FileNotes.page,
+                FileNotes.x, FileNotes.y,
+                FileNotes.author, FileNotes.note,
+                FileNotes.modifiedTime,
+                FileNotes.documentId,
+                DocumentFolders.folderid,
+                Folders.name
+        FROM Files
+        LEFT JOIN FileNotes
+            ON FileNotes.fileHash=Files.hash
+        LEFT JOIN DocumentFolders
+            ON DocumentFolders.documentId=FileNotes.documentId
+        LEFT JOIN Folders
+            ON Folders.id=DocumentFolders.folderid
+        WHERE (FileNotes.page IS NOT NULL)
+'''
+
+DOCNOTE_QUERY=\
+'''SELECT DocumentNotes.text,
+          DocumentNotes.documentId,
+          DocumentNotes.baseNote,
+          DocumentFiles.hash,
+          Documents.title,
+          DocumentFolders.folderid,
+          Folders.name
+        FROM DocumentNotes
+        LEFT JOIN DocumentFolders
+            ON DocumentFolders.documentId=DocumentNotes.documentId
+        LEFT JOIN Folders
+            ON Folders.id=DocumentFolders.folderid
+        LEFT JOIN DocumentFiles
+            ON DocumentFiles.documentId=DocumentNotes.documentId
+        LEFT JOIN Documents
+            ON Documents.id=DocumentNotes.documentId
+        WHERE (DocumentNotes.documentId IS NOT NULL)
+'''
+
+class FolderAnnoRows(object):
+
+    def __init__(self,db):
+        '''Obj to hold annotation rows of all folders, partitioned by folder id.
+
+        <db>: sqlite3.connection to Mendeley sqlite database.
+
+        Each of HIGHLIGHT_QUERY, NOTE_QUERY and DOCNOTE_QUERY is run once
+        without folder filtering. The rows of a folder are then passed to
+        getHighlights(), getNotes() and getDocNotes() via their <rows>
+        argument, so processing all folders costs about the same as
+        processing one.
+        '''
+
+        try:
+            ret=db.execute(HIGHLIGHT_QUERY)
+        except:
+            ret=db.execute(HIGHLIGHT_QUERY_OLD)
+
+        self.highlights=self._partition(ret,8)
+        self.notes=self._partition(db.execute(NOTE_QUERY),8)
+        self.docnotes=self._partition(db.execute(DOCNOTE_QUERY),5)
+
+    @staticmethod
+    def _partition(rows,idx):
+        '''Group rows by the folder id in column <idx>
+        '''
+        result={}
+        for r in rows:
+            result.setdefault(r[idx],[]).append(r)
+        return result
+
+    def getRows(self,folderid):
+        '''Get (highlight rows, note rows, side-bar note rows) of a folder
+        '''
+        return self.highlights.get(folderid,[]),\
+                self.notes.get(folderid,[]),\
+                self.docnotes.get(folderid,[])
+
+
+def getHighlights(db,results=None,folderid=None,foldername=None,filterdocid=None,\
+        filterdocids=None,rows=None):
     '''Extract the coordinates of highlights from the Mendeley database
     and put results into a dictionary.
 
@@ -224,6 +558,10 @@ def getHighlights(db,results=None,folderid=None,foldername=None,filterdocid=None
     <foldername>: str, name of folder corresponding to <folderid>. Used to
                   populate meta data.
     <filterdocid>: int, id of document to query. If None, don't do docid filtering.
+    <filterdocids>: list or set, ids of documents to query in bulk, using a
+                    single query. If None, don't do bulk docid filtering.
+    <rows>: list or None, rows of <folderid> pre-fetched by FolderAnnoRows.
+            If given, use these instead of querying the database.
 
     Return: <results>: dictionary containing the query results, with
             the following structure:
@@ -254,45 +592,8 @@ def getHighlights(db,results=None,folderid=None,foldername=None,filterdocid=None
     Update time: 2016-02-24 00:36:33.
     '''
 
-    query_new =\
-    '''SELECT Files.localUrl, FileHighlightRects.page,
-                    FileHighlightRects.x1, FileHighlightRects.y1,
-                    FileHighlightRects.x2, FileHighlightRects.y2,
-                    FileHighlights.createdTime,
-                    FileHighlights.documentId,
-                    DocumentFolders.folderid,
-                    Folders.name,
-                    FileHighlights.color
-            FROM Files
-            LEFT JOIN FileHighlights
-                ON FileHighlights.fileHash=Files.hash
-            LEFT JOIN FileHighlightRects
-                ON FileHighlightRects.highlightId=FileHighlights.id
-            LEFT JOIN DocumentFolders
-                ON DocumentFolders.documentId=FileHighlights.documentId
-            LEFT JOIN Folders
-                ON Folders.id=DocumentFolders.folderid
-            WHERE (FileHighlightRects.page IS NOT NULL)
-    '''
-    query_old =\
-    '''SELECT Files.localUrl, FileHighlightRects.page,
-                    FileHighlightRects.x1, FileHighlightRects.y1,
-                    FileHighlightRects.x2, FileHighlightRects.y2,
-                    FileHighlights.createdTime,
-                    FileHighlights.documentId,
-                    DocumentFolders.folderid,
-                    Folders.name
-            FROM Files
-            LEFT JOIN FileHighlights
-                ON FileHighlights.fileHash=Files.hash
-            LEFT JOIN FileHighlightRects
-                ON FileHighlightRects.highlightId=FileHighlights.id
-            LEFT JOIN DocumentFolders
-                ON DocumentFolders.documentId=FileHighlights.documentId
-            LEFT JOIN Folders
-                ON Folders.id=DocumentFolders.folderid
-            WHERE (FileHighlightRects.page IS NOT NULL)
-    '''
+    query_new=HIGHLIGHT_QUERY
+    query_old=HIGHLIGHT_QUERY_OLD
 
     query_canonical_new =\
     '''SELECT Files.localUrl, FileHighlightRects.page,
@@ -323,7 +624,9 @@ def getHighlights(db,results=None,folderid=None,foldername=None,filterdocid=None
             WHERE (FileHighlightRects.page IS NOT NULL)
     '''
 
-    if folderid is not None and filterdocid is None:
+    iscanonical=filterdocid is not None or filterdocids is not None
+
+    if folderid is not None and not iscanonical:
         fstr='(Folders.id="%s")' %folderid
         query_new=query_new+' AND\n'+fstr
         query_old=query_old+' AND\n'+fstr
@@ -333,26 +636,40 @@ def getHighlights(db,results=None,folderid=None,foldername=None,filterdocid=None
         query_new=query_canonical_new+' AND\n'+fstr
         query_old=query_canonical_old+' AND\n'+fstr
 
+    if filterdocids is not None:
+        # Filter while streaming, as an IN (...) list can get too long.
+        query_new=query_canonical_new
+        query_old=query_canonical_old
+        filterdocids=set(filterdocids)
+
     if results is None:
         results={}
 
+    resolver=getDbCache(db,PathResolver)
+
     #------------------Get highlights------------------
-    try:
-	ret = db.execute(query_new)
-	hascolor=True
-    except:
-	ret = db.execute(query_old)
-	hascolor=False
+    if rows is not None:
+        ret=rows
+        hascolor=len(rows)>0 and len(rows[0])>10
+    else:
+        try:
+            ret = db.execute(query_new)
+            hascolor=True
+        except:
+            ret = db.execute(query_old)
+            hascolor=False
 
     for ii,r in enumerate(ret):
-        pth = converturl2abspath(r[0])
+        docid=r[7]
+        if filterdocids is not None and docid not in filterdocids:
+            continue
+        pth = resolver.resolveUrl(r[0])
         pg = r[1]
         bbox = [r[2], r[3], r[4], r[5]] 
         # [x1,y1,x2,y2], (x1,y1) being bottom-left,
         # (x2,y2) being top-right. Origin at bottom-left
         cdate = convert2datetime(r[6])
-        docid=r[7]
-        if filterdocid is None:
+        if not iscanonical:
             folder=r[9]
             if hascolor:
                 color=r[10]
@@ -403,7 +720,8 @@ def getHighlights(db,results=None,folderid=None,foldername=None,filterdocid=None
 
 
 #-------------------Get sticky notes-------------------
-def getNotes(db,results=None,folderid=None,foldername=None,filterdocid=None):
+def getNotes(db,results=None,folderid=None,foldername=None,filterdocid=None,\
+        filterdocids=None,rows=None):
     '''Extract notes from the Mendeley database
 
     <db>: sqlite3.connection to Mendeley sqlite database.
@@ -412,29 +730,17 @@ def getNotes(db,results=None,folderid=None,foldername=None,filterdocid=None):
     <foldername>: str, name of folder corresponding to <folderid>. Used to
                   populate meta data.
     <filterdocid>: int, id of document to query. If None, don't do docid filtering.
+    <filterdocids>: list or set, ids of documents to query in bulk, using a
+                    single query. If None, don't do bulk docid filtering.
+    <rows>: list or None, rows of <folderid> pre-fetched by FolderAnnoRows.
+            If given, use these instead of querying the database.
 
     Return: <results>: dictionary containing the query results. See
             more in the doc of getHighlights()
     Update time: 2016-04-12 20:39:15.
     '''
 
-    query=\
-    '''SELECT Files.localUrl, FileNotes.page,
-                    FileNotes.x, FileNotes.y,
-                    FileNotes.author, FileNotes.note,
-                    FileNotes.modifiedTime,
-                    FileNotes.documentId,
-                    DocumentFolders.folderid,
-                    Folders.name
-            FROM Files
-            LEFT JOIN FileNotes
-                ON FileNotes.fileHash=Files.hash
-            LEFT JOIN DocumentFolders
-                ON DocumentFolders.documentId=FileNotes.documentId
-            LEFT JOIN Folders
-                ON Folders.id=DocumentFolders.folderid
-            WHERE (FileNotes.page IS NOT NULL)
-    '''
+    query=NOTE_QUERY
 
     query_canonical=\
     '''SELECT Files.localUrl, FileNotes.page,
@@ -448,7 +754,9 @@ def getNotes(db,results=None,folderid=None,foldername=None,filterdocid=None):
             WHERE (FileNotes.page IS NOT NULL)
     '''
 
-    if folderid is not None and filterdocid is None:
+    iscanonical=filterdocid is not None or filterdocids is not None
+
+    if folderid is not None and not iscanonical:
         fstr='(Folders.id="%s")' %folderid
         query=query+' AND\n'+fstr
 
@@ -456,14 +764,23 @@ def getNotes(db,results=None,folderid=None,foldername=None,filterdocid=None):
         fstr='(FileNotes.documentId="%s")' %filterdocid
         query=query_canonical+' AND\n'+fstr
 
+    if filterdocids is not None:
+        query=query_canonical
+        filterdocids=set(filterdocids)
+
     if results is None:
         results={}
 
+    resolver=getDbCache(db,PathResolver)
+
     #------------------Get notes------------------
-    ret = db.execute(query)
+    ret = db.execute(query) if rows is None else rows
 
     for ii,r in enumerate(ret):
-        pth = converturl2abspath(r[0])
+        docid=r[7]
+        if filterdocids is not None and docid not in filterdocids:
+            continue
+        pth = resolver.resolveUrl(r[0])
    
         pg = r[1]
         bbox = [r[2], r[3], r[2]+30, r[3]+30] 
@@ -471,8 +788,7 @@ def getNotes(db,results=None,folderid=None,foldername=None,filterdocid=None):
         author=r[4]
         txt = r[5]
         cdate = convert2datetime(r[6])
-        docid=r[7]
-        if filterdocid is None:
+        if not iscanonical:
             folder=r[9]
         else:
             folder=None
@@ -516,7 +832,8 @@ def getNotes(db,results=None,folderid=None,foldername=None,filterdocid=None):
 
 
 #-------------------Get side-bar notes-------------------
-def getDocNotes(db,results=None,folderid=None,foldername=None,filterdocid=None):
+def getDocNotes(db,results=None,folderid=None,foldername=None,filterdocid=None,\
+        filterdocids=None,rows=None):
     '''Extract side-bar notes from the Mendeley database
 
     <db>: sqlite3.connection to Mendeley sqlite database.
@@ -525,31 +842,17 @@ def getDocNotes(db,results=None,folderid=None,foldername=None,filterdocid=None):
     <foldername>: str, name of folder corresponding to <folderid>. Used to
                   populate meta data.
     <filterdocid>: int, id of document to query. If None, don't do docid filtering.
+    <filterdocids>: list or set, ids of documents to query in bulk, using a
+                    single query. If None, don't do bulk docid filtering.
+    <rows>: list or None, rows of <folderid> pre-fetched by FolderAnnoRows.
+            If given, use these instead of querying the database.
 
     Return: <results>: dictionary containing the query results. with
             See the doc in getHighlights().
     Update time: 2016-04-12 20:44:38.
     '''
 
-    query=\
-    '''SELECT DocumentNotes.text,
-              DocumentNotes.documentId,
-              DocumentNotes.baseNote,
-              DocumentFiles.hash,
-              Documents.title,
-              DocumentFolders.folderid,
-              Folders.name
-            FROM DocumentNotes
-            LEFT JOIN DocumentFolders
-                ON DocumentFolders.documentId=DocumentNotes.documentId
-            LEFT JOIN Folders
-                ON Folders.id=DocumentFolders.folderid
-            LEFT JOIN DocumentFiles
-                ON DocumentFiles.documentId=DocumentNotes.documentId
-            LEFT JOIN Documents
-                ON Documents.id=DocumentNotes.documentId
-            WHERE (DocumentNotes.documentId IS NOT NULL)
-    '''
+    query=DOCNOTE_QUERY
     query_canonical=\
     '''SELECT DocumentNotes.text,
               DocumentNotes.documentId,
@@ -564,7 +867,9 @@ def getDocNotes(db,results=None,folderid=None,foldername=None,filterdocid=None):
             WHERE (DocumentNotes.documentId IS NOT NULL)
     '''
 
-    if filterdocid is None and folderid is not None:
+    iscanonical=filterdocid is not None or filterdocids is not None
+
+    if folderid is not None and not iscanonical:
         fstr='(Folders.id="%s")' %folderid
         query=query+' AND\n'+fstr
 
@@ -572,18 +877,24 @@ def getDocNotes(db,results=None,folderid=None,foldername=None,filterdocid=None):
         fstr='(Documents.id="%s")' %filterdocid
         query=query_canonical+' AND\n'+fstr
 
+    if filterdocids is not None:
+        query=query_canonical
+        filterdocids=set(filterdocids)
+
     if results is None:
         results={}
 
     #------------------Get notes------------------
-    ret = db.execute(query)
+    ret = db.execute(query) if rows is None else rows
 
     for ii,r in enumerate(ret):
-        docnote=r[0]
         docid=r[1]
+        if filterdocids is not None and docid not in filterdocids:
+            continue
+        docnote=r[0]
         basenote=r[2]
         title=r[4]
-        if filterdocid is None:
+        if not iscanonical:
             folder=r[6]
         else:
             folder=None
@@ -612,7 +923,8 @@ def getDocNotes(db,results=None,folderid=None,foldername=None,filterdocid=None):
                 'author':'Mendeley user',\
                 'content':docnote,\
                 'cdate': datetime.now(),\
-                'page':pg\
+                'page':pg,\
+                'sidebar':True\
                   }
 
         #-------------------Save to dict-------------------
@@ -733,10 +1045,7 @@ def getFolderDocList(db,folderid,verbose=True):
         query=query+' '+fstr
 
     #------------------Get docids------------------
-    ret=db.execute(query)
-    data=ret.fetchall()
-    df=pd.DataFrame(data=data,columns=['docid','folderid','folder'])
-    docids=fetchField(df,'docid')
+    docids=fetchField(db.execute(query),'id')
 
     return docids
 
@@ -755,16 +1064,185 @@ def getCanonicals(db,verbose=True):
        WHERE (DocumentFolders.folderId IS NULL)
     '''
 
-    ret=db.execute(query)
-    data=ret.fetchall()
-    df=pd.DataFrame(data=data,columns=['docid','folderid'])
-    canonical_doc_ids=fetchField(df,'docid')
+    canonical_doc_ids=fetchField(db.execute(query),'id')
 
     return [int(ii) for ii in canonical_doc_ids]
 
 
 
 
+class FolderStats(object):
+
+    doc_query=\
+    '''SELECT DocumentFolders.folderid,
+              COUNT(Documents.id)
+       FROM Documents
+       JOIN DocumentFolders
+           ON Documents.id=DocumentFolders.documentId
+       GROUP BY DocumentFolders.folderid
+    '''
+
+    highlight_query=\
+    '''SELECT DocumentFolders.folderid,
+              COUNT(FileHighlights.id)
+       FROM FileHighlights
+       JOIN DocumentFolders
+           ON DocumentFolders.documentId=FileHighlights.documentId
+       GROUP BY DocumentFolders.folderid
+    '''
+
+    note_query=\
+    '''SELECT DocumentFolders.folderid,
+              COUNT(FileNotes.id)
+       FROM FileNotes
+       JOIN DocumentFolders
+           ON DocumentFolders.documentId=FileNotes.documentId
+       GROUP BY DocumentFolders.folderid
+    '''
+
+    docnote_query=\
+    '''SELECT DocumentFolders.folderid,
+              COUNT(DocumentNotes.id)
+       FROM DocumentNotes
+       JOIN DocumentFolders
+           ON DocumentFolders.documentId=DocumentNotes.documentId
+       GROUP BY DocumentFolders.folderid
+    '''
+
+    def __init__(self,db):
+        '''Obj to hold number of documents, highlights and notes in each folder.
+
+        <db>: sqlite3.connection to Mendeley sqlite database.
+
+        Each count is obtained for all folders with a single GROUP BY
+        query. Notes include sticky notes and side-bar notes.
+        '''
+
+        self.ndocs=dict(db.execute(self.doc_query).fetchall())
+        self.nhighlights=dict(db.execute(self.highlight_query).fetchall())
+        self.nnotes=dict(db.execute(self.note_query).fetchall())
+        for fid,nn in db.execute(self.docnote_query):
+            self.nnotes[fid]=self.nnotes.get(fid,0)+nn
+
+    def isEmpty(self,folderid):
+        '''Check a folder has no document
+        '''
+        return self.ndocs.get(folderid,0)==0
+
+    def getCounts(self,folderid):
+        '''Get (number of docs, highlights, notes) in a folder
+        '''
+        return self.ndocs.get(folderid,0),\
+                self.nhighlights.get(folderid,0),\
+                self.nnotes.get(folderid,0)
+
+    def hasWork(self,folderid,action):
+        '''Check a folder has anything to export for <action>
+
+        Exporting PDFs, .bib or .ris needs any document, extracting
+        highlights (notes) needs any highlight (note).
+        '''
+        ndocs,nhls,nnts=self.getCounts(folderid)
+        if 'p' in action or 'b' in action or 'r' in action:
+            return ndocs>0
+        return ('m' in action and nhls>0) or ('n' in action and nnts>0)
+
+
+class FolderTree(object):
+
+    query=\
+    '''SELECT Folders.id,
+              Folders.name,
+              Folders.parentID
+       FROM Folders
+    '''
+
+    def __init__(self,db):
+        '''Obj to hold the folder tree structure of the library.
+
+        <db>: sqlite3.connection to Mendeley sqlite database.
+
+        Folders are read in a single query into parent and child maps,
+        from which descendants and tree paths are derived without
+        further queries.
+        '''
+
+        self.folderids=[]  # in database order
+        self.names={}
+        self.parents={}
+        self.children={}
+
+        for fid,name,pid in db.execute(self.query):
+            if fid in self.names:
+                continue
+            self.folderids.append(fid)
+            self.names[fid]=name
+            self.parents[fid]=pid
+
+        for fid in self.folderids:
+            if not self.isRoot(fid):
+                self.children.setdefault(self.parents[fid],[]).append(fid)
+
+        self._paths={}
+
+    def isRoot(self,folderid):
+        '''A folder with parentID -1/0, or a parent not found, is top-level
+        '''
+        pid=self.parents[folderid]
+        return pid==-1 or pid==0 or pid not in self.names
+
+    def findByName(self,name):
+        '''Get ids of folders named <name>, the ones with lower parentID first
+        '''
+        fids=[ff for ff in self.folderids if self.names[ff]==name]
+        fids.sort(key=lambda x: self.parents[x])
+        return fids
+
+    def getDescendants(self,folderid):
+        '''Get ids of all subfolders (at any depth) of a folder, sorted
+        '''
+        results=[]
+        seen=set([folderid,])
+        stack=list(self.children.get(folderid,[]))
+        while stack:
+            fid=stack.pop()
+            if fid in seen:
+                continue
+            seen.add(fid)
+            results.append(fid)
+            stack.extend(self.children.get(fid,[]))
+
+        results.sort()
+        return results
+
+    def getPath(self,folderid):
+        '''Get folder name with tree structure, e.g. test/testsub/testsub2
+        '''
+        if folderid in self._paths:
+            return self._paths[folderid]
+
+        #------------Back track tree structure------------
+        chain=[]
+        seen=set()
+        cid=folderid
+        while cid not in self._paths and cid not in seen:
+            seen.add(cid)
+            chain.append(cid)
+            if self.isRoot(cid):
+                break
+            cid=self.parents[cid]
+
+        # Fill in paths from the top, reusing the ones known already.
+        for fid in reversed(chain):
+            if self.isRoot(fid) or self.parents[fid] not in self._paths:
+                self._paths[fid]=self.names[fid]
+            else:
+                self._paths[fid]=u'%s/%s' %(self._paths[self.parents[fid]],\
+                        self.names[fid])
+
+        return self._paths[folderid]
+
+
 #--------------Get folder id and name list in database----------------
 def getFolderList(db,folder,verbose=True):
     '''Get folder id and name list in database
@@ -783,37 +1261,26 @@ def getFolderList(db,folder,verbose=True):
     Update time: 2016-06-16 19:38:15.
     '''
 
-    query=\
-    '''SELECT Folders.id,
-              Folders.name,
-              Folders.parentID
-       FROM Folders
-    '''
-
     #-----------------Get all folders-----------------
-    ret=db.execute(query)
-    data=ret.fetchall()
-    df=pd.DataFrame(data=data,columns=['folderid','folder','parentID'])
-    allfolderids=fetchField(df,'folderid')
+    tree=getDbCache(db,FolderTree)
 
     #---------------Select target folder---------------
     if folder is None:
-        folderids=allfolderids
+        folderids=tree.folderids
     if type(folder) is str:
         # Select the given folder, if more than 1 name match, select the
         # one with lowest parentID.
-        seldf=df[df.folder==folder].sort_values('parentID')
-        folderids=fetchField(seldf,'folderid')
+        folderids=tree.findByName(folder)
     elif type(folder) is tuple or type(folder) is list:
-        seldf=df[(df.folderid==folder[0]) & (df.folder==folder[1])]
-        folderids=fetchField(seldf,'folderid')
+        folderids=[ff for ff in tree.folderids if ff==folder[0] and\
+                tree.names[ff]==folder[1]]
 
     #----------------Get all subfolders----------------
     if folder is not None:
         folderids2=[]
         for ff in folderids:
             folderids2.append(ff)
-            subfs=getSubFolders(df,ff)
+            subfs=getSubFolders(tree,ff)
             folderids2.extend(subfs)
     else:
         folderids2=folderids
@@ -824,7 +1291,7 @@ def getFolderList(db,folder,verbose=True):
     #---Get names and tree structure of all non-empty folders---
     folders=[]
     for ff in folderids2:
-        folders.append(getFolderTree(df,ff))
+        folders.append(getFolderTree(tree,ff))
 
     #----------------------Return----------------------
     if folder is None:
@@ -840,88 +1307,157 @@ def getFolderList(db,folder,verbose=True):
 #--------------------Check a folder is empty or not--------------------
 def isFolderEmpty(db,folderid,verbose=True):
     '''Check a folder is empty or not
-    '''
 
-    query=\
-    '''SELECT Documents.title,
-              DocumentFolders.folderid,
-              Folders.name
-       FROM Documents
-       LEFT JOIN DocumentFolders
-           ON Documents.id=DocumentFolders.documentId
-       LEFT JOIN Folders
-           ON Folders.id=DocumentFolders.folderid
+    Looked up from the FolderStats of <db>, which is loaded on the 1st call.
     '''
 
-    fstr='(Folders.id="%s")' %folderid
-    fstr='WHERE '+fstr
-    query=query+' '+fstr
-
-    ret=db.execute(query)
-    data=ret.fetchall()
-    if len(data)==0:
-        return True
-    else:
-        return False
+    return getDbCache(db,FolderStats).isEmpty(folderid)
 
 
 #-------------------Get subfolders of a given folder-------------------
-def getSubFolders(df,folderid,verbose=True):
+def getSubFolders(tree,folderid,verbose=True):
     '''Get subfolders of a given folder
 
-    <df>: dataframe, contains all folders (including empty ones) id, name and parentID.
+    <tree>: FolderTree obj, contains all folders (including empty ones).
     <folderid>: int, folder id
     '''
-    getParentId=lambda df,id: fetchField(df[df.folderid==id],'parentID')[0]
-    results=[]
-
-    for ii in range(len(df)):
-        idii,fii,pii=df.loc[ii]
-
-        cid=idii
-        while True:
-            pid=getParentId(df,cid)
-            if pid==-1 or pid==0:
-                break
-            if pid==folderid:
-                results.append(idii)
-                break
-            else:
-                cid=pid
 
-    results.sort()
-    return results
+    return tree.getDescendants(folderid)
 
 
 #-------------Get folder tree structure of a given folder-------------
-def getFolderTree(df,folderid,verbose=True):
+def getFolderTree(tree,folderid,verbose=True):
     '''Get folder tree structure of a given folder
 
-    <df>: dataframe, contains all folders (including empty ones) id, name and parentID.
+    <tree>: FolderTree obj, contains all folders (including empty ones).
     <folderid>: int, folder id
     '''
 
-    getFolderName=lambda df,id: fetchField(df[df.folderid==id],'folder')[0]
-    getParentId=lambda df,id: fetchField(df[df.folderid==id],'parentID')[0]
+    return folderid,tree.getPath(folderid)
 
-    folder=getFolderName(df,folderid)
 
-    #------------Back track tree structure------------
-    cid=folderid
-    while True:
-        pid=getParentId(df,cid)
-        if pid==-1 or pid==0:
-            break
-        else:
-            pfolder=getFolderName(df,pid)
-            folder=u'%s/%s' %(pfolder,folder)
-        cid=pid
 
-    return folderid,folder
+#-------------Extract annotations from a single PDF-------------
+def extractDocAnnos(annoii,action,verbose,cache=None,filehash=None,\
+        engine='layout',session=None):
+    '''Extract highlights and notes from a single PDF.
 
+    <annoii>: FileAnno obj.
+    <action>: list, possible elements: m, n, e, b.
+    <cache>: AnnoCache obj or None, cache of highlighted texts.
+    <filehash>: str or None, Files.hash of the PDF, to look up <cache> with.
+    <engine>: str, 'layout' or 'chars', how chars are grouped into text
+              boxes in highlight extraction, see extracthl2.ENGINES.
+    <session>: extracthl2.ExtractSession obj or None, pdfminer resource
+               manager shared with other PDFs.
+
+    Return <hltexts>: list, Anno objs of highlights.
+           <nttexts>: list, Anno objs of notes.
+           <faillist>: list, file name of <annoii> once for each failed
+                       extraction.
+    '''
+
+    faillist=[]
+    fii=annoii.path
+    fnameii=annoii.filename
+
+    if 'm' in action:
+        from lib import extracthl2
+
+        try:
+            #------ Check if pdftotext is available--------
+            if extracthl2.checkPdftotext():
+                if verbose:
+                    printInd('Retrieving highlights using pdftotext ...',4,prefix='# <Menotexport>:')
+                hltexts=extracthl2.extractHighlights2(fii,annoii,verbose,\
+                        cache,filehash,engine,session)
+            else:
+                if verbose:
+                    printInd('Retrieving highlights using pdfminer ...',4,prefix='# <Menotexport>:')
+                hltexts=extracthl2.extractHighlights(fii,annoii,verbose,\
+                        cache,filehash,engine,session)
+        except:
+            faillist.append(fnameii)
+            hltexts=[]
+    else:
+        hltexts=[]
+
+    if 'n' in action:
+        if verbose:
+            printInd('Retrieving notes...',4,prefix='# <Menotexport>:')
+        try:
+            nttexts=extractnt.extractNotes(fii,annoii,verbose)
+        except:
+            faillist.append(fnameii)
+            nttexts=[]
+    else:
+        nttexts=[]
+
+    return hltexts,nttexts,faillist
+
+
+# Meta-data fields read by the highlight and note extractions
+_EXTRACT_META_FIELDS=['path','title','citationkey','tags']
+
+def newPool(jobs):
+    '''Create a pool of <jobs> worker processes
+
+    Workers are replaced after 50 tasks, to bound the memory kept by
+    pdfminer and PyPDF2 over a long run.
+    '''
+    return multiprocessing.Pool(jobs,maxtasksperchild=50)
 
 
-def extractAnnos(annotations,action,verbose):
+# ExtractSession of a worker process, kept across its jobs
+_worker_session=None
+
+def newExtractSession():
+    '''Create an ExtractSession to share pdfminer fonts across PDFs
+    '''
+    from lib import extracthl2
+    return extracthl2.ExtractSession()
+
+def _extractDocJob(job):
+    '''Run extractDocAnnos() in a worker process
+
+    <job>: tuple, (docid, meta, highlights, notes, action, cache, filehash,
+           engine), <meta> being reduced to _EXTRACT_META_FIELDS to keep pickling
+           cheap.
+    '''
+    global _worker_session
+
+    docid,meta,highlights,notes,action,cache,filehash,engine=job
+    if 'm' in action and _worker_session is None:
+        _worker_session=newExtractSession()
+    annoii=FileAnno(docid,meta,highlights,notes)
+    result=extractDocAnnos(annoii,action,False,cache,filehash,engine,\
+            _worker_session)
+    # <cache> is unpickled for each job, and not closed
+    if cache is not None:
+        cache.flush()
+    return result
+
+
+
+def extractAnnos(annotations,action,verbose,jobs=1,cache=None,\
+        engine='layout',pool=None):
+    '''Extract highlights and notes from PDFs.
+
+    <annotations>: dict, keys: documentId; values: FileAnno objs.
+    <action>: list, possible elements: m, n, e, b.
+    <jobs>: int, number of worker processes. If > 1, documents are
+            distributed to a process pool. Results are collected in the
+            order of <annotations> regardless of <jobs>.
+    <cache>: AnnoCache obj or None. If given, highlighted texts are
+             looked up in and saved to it, by the file hash from
+             <cache>.gethash.
+    <engine>: str, 'layout' or 'chars', see extractDocAnnos().
+    <pool>: multiprocessing.Pool obj or None, pool of the run to use if
+            <jobs> > 1. If None, a pool is created for the call.
+
+    Fonts parsed by pdfminer are shared across documents, by one
+    ExtractSession for the call, or one per worker process.
+    '''
 
     faillist=[]
     annotations2={}  #keys: docid, values: extracted annotations
@@ -929,55 +1465,69 @@ def extractAnnos(annotations,action,verbose):
     #-----------Loop through documents---------------
     num=len(annotations)
     docids=annotations.keys()
+    filehashes={}
+    if cache is not None:
+        for idii in docids:
+            filehashes[idii]=cache.gethash(idii)
+
+    if jobs>1 and num>1:
+        jobsii=[]
+        for idii in docids:
+            annoii=annotations[idii]
+            metaii=dict((kk,annoii.meta[kk]) for kk in _EXTRACT_META_FIELDS)
+            jobsii.append((idii,metaii,annoii.highlights,annoii.notes,action,\
+                    cache,filehashes.get(idii),engine))
+
+        ownpool=pool is None
+        if ownpool:
+            pool=newPool(min(jobs,num))
+        try:
+            results=pool.imap(_extractDocJob,jobsii)
+            for ii,idii in enumerate(docids):
+                hltexts,nttexts,flist=results.next()
+                if verbose:
+                    printNumHeader('Processing file:',ii+1,num,3)
+                    printInd(annotations[idii].filename,4)
+                annoii=annotations[idii]
+                annoii.highlights=hltexts
+                annoii.notes=nttexts
+                annotations2[idii]=annoii
+                faillist.extend(flist)
+        finally:
+            if ownpool:
+                pool.close()
+                pool.join()
+
+        return annotations2,faillist
+
+    session=newExtractSession() if 'm' in action else None
     for ii,idii in enumerate(docids):
         annoii=annotations[idii]
-        fii=annoii.path
-        fnameii=annoii.filename
 
         if verbose:
             printNumHeader('Processing file:',ii+1,num,3)
-            printInd(fnameii,4)
-
-        if 'm' in action:
-            from lib import extracthl2
+            printInd(annoii.filename,4)
 
-            try:
-	        #------ Check if pdftotext is available--------
-	        if extracthl2.checkPdftotext():
-		    if verbose:
-			printInd('Retrieving highlights using pdftotext ...',4,prefix='# <Menotexport>:')
-                    hltexts=extracthl2.extractHighlights2(fii,annoii,verbose)
-	        else:
-		    if verbose:
-			printInd('Retrieving highlights using pdfminer ...',4,prefix='# <Menotexport>:')
-                    hltexts=extracthl2.extractHighlights(fii,annoii,verbose)
-            except:
-                faillist.append(fnameii)
-                hltexts=[]
-        else:
-            hltexts=[]
-
-        if 'n' in action:
-            if verbose:
-                printInd('Retrieving notes...',4,prefix='# <Menotexport>:')
-            try:
-                nttexts=extractnt.extractNotes(fii,annoii,verbose)
-            except:
-                faillist.append(fnameii)
-                nttexts=[]
-        else:
-            nttexts=[]
+        hltexts,nttexts,flist=extractDocAnnos(annoii,action,verbose,\
+                cache,filehashes.get(idii),engine,session)
+        faillist.extend(flist)
 
         annoii.highlights=hltexts
         annoii.notes=nttexts
         annotations2[idii]=annoii
 
+    # Write texts extracted from this folder to the cache in one go
+    if cache is not None:
+        cache.flush()
+
     return annotations2,faillist
 
 
         
 def processFolder(db,outdir,annotations,folderid,foldername,allfolders,action,\
-        separate,iszotero,verbose):
+        separate,iszotero,verbose,annorows=None,jobs=1,manifest=None,\
+        copier=None,cache=None,engine='layout',outfiles=None,tables=None,\
+        pool=None):
     '''Process files/docs in a folder.
 
     <db>: sqlite database.
@@ -990,6 +1540,22 @@ def processFolder(db,outdir,annotations,folderid,foldername,allfolders,action,\
     <action>: list, possible elements: m, n, e, b.
     <separate>: bool, whether save one output for each file or all files.
     <iszotero>: bool, whether exported .bib is reformated to cater to zotero import or not.
+    <annorows>: FolderAnnoRows obj or None. If given, take the annotation rows
+                of <folderid> from it instead of querying the database.
+    <jobs>: int, number of worker processes to export PDFs and extract
+            annotations with.
+    <manifest>: ExportManifest obj or None. If given, skip exporting PDFs
+                unchanged since the last run.
+    <copier>: PdfCopier obj or None, to copy un-annotated PDFs with.
+    <cache>: AnnoCache obj or None, cache of highlighted texts.
+    <engine>: str, 'layout' or 'chars', how chars are grouped into text
+              boxes in highlight extraction.
+    <outfiles>: OutputFiles obj or None, buffered writers of output text,
+                .bib and .ris files, kept open for the whole run.
+    <tables>: TableFiles obj or None. If given, highlights and notes are
+              also exported to a data table, one row each.
+    <pool>: multiprocessing.Pool obj or None, worker processes of the run,
+            used if <jobs> > 1.
     '''
     
     exportfaillist=[]
@@ -1004,12 +1570,20 @@ def processFolder(db,outdir,annotations,folderid,foldername,allfolders,action,\
     if 'n' in action or 'p' in action:
         isnote=True
 
+    if annorows is not None:
+        hlrows,ntrows,docntrows=annorows.getRows(folderid)
+    else:
+        hlrows,ntrows,docntrows=None,None,None
+
     #------------Get raw annotation data------------
     if ishighlight:
-        annotations = getHighlights(db,annotations,folderid,foldername)
+        annotations = getHighlights(db,annotations,folderid,foldername,\
+                rows=hlrows)
     if isnote:
-        annotations = getNotes(db, annotations, folderid,foldername)
-        annotations = getDocNotes(db, annotations, folderid,foldername)
+        annotations = getNotes(db, annotations, folderid,foldername,\
+                rows=ntrows)
+        annotations = getDocNotes(db, annotations, folderid,foldername,\
+                rows=docntrows)
 
     if len(annotations)==0:
         printHeader('No annotations found in folder: %s' %foldername,2)
@@ -1033,21 +1607,23 @@ def processFolder(db,outdir,annotations,folderid,foldername,allfolders,action,\
             if verbose:
                 printHeader('Exporting annotated PDFs ...',2)
             flist=exportpdf.exportAnnoPdf(annotations,\
-                    outdir_folder,verbose)
+                    outdir_folder,verbose,jobs,manifest,pool)
             exportfaillist.extend(flist)
     
         #--------Copy other PDFs to target location--------
         if len(otherdocs)>0:
             if verbose:
                 printHeader('Exporting un-annotated PDFs ...',2)
-            flist=exportpdf.copyPdf(otherdocs,outdir_folder,verbose)
+            flist=exportpdf.copyPdf(otherdocs,outdir_folder,verbose,\
+                    manifest,copier)
             exportfaillist.extend(flist)
 
     #----------Extract annotations from PDFs----------
     if len(annotations)>0:
         if verbose:
             printHeader('Extracting annotations from PDFs ...',2)
-        annotations,flist=extractAnnos(annotations,action,verbose)
+        annotations,flist=extractAnnos(annotations,action,verbose,jobs,\
+                cache,engine,pool)
         annofaillist.extend(flist)
 
     #------------Export annotations to txt------------
@@ -1055,12 +1631,22 @@ def processFolder(db,outdir,annotations,folderid,foldername,allfolders,action,\
         if verbose:
             printHeader('Exporting annotations to text file...',2)
         flist=exportannotation.exportAnno(annotations,outdir_folder,action,\
-                separate,verbose)
+                separate,verbose,outfiles)
         annofaillist.extend(flist)
 
         #--------Export annotations grouped by tags--------
         tagsdict=extracttags.groupByTags(annotations)
-        extracttags.exportAnno(tagsdict,outdir_folder,action,verbose)
+        extracttags.exportAnno(tagsdict,outdir_folder,action,verbose,\
+                outfiles)
+
+    #----------Export annotations to a data table----------
+    if tables is not None and ('m' in action or 'n' in action) and\
+            len(annotations)>0:
+        if verbose:
+            printHeader('Exporting annotations to %s table...' %tables.fmt,2)
+        tablefolder=outdir if allfolders else outdir_folder
+        export2table.exportAnno2Table(annotations,tablefolder,\
+                allfolders,tables,verbose)
 
     #----------Export meta and anno to bib file----------
     if 'b' in action:
@@ -1077,13 +1663,13 @@ def processFolder(db,outdir,annotations,folderid,foldername,allfolders,action,\
             # <bibfolder> is the folder to save .bib file, which is <outdir> if <allfolders> is True,
             # or <outdir>/<folder_tree> otherwise.
             flist=export2bib.exportAnno2Bib(annotations,outdir,\
-                bibfolder,allfolders,isfile,iszotero,verbose)
+                bibfolder,allfolders,isfile,iszotero,verbose,outfiles)
             bibfaillist.extend(flist)
 
         #------Export other docs without annotations------
         if len(otherdocs)>0:
             flist=export2bib.exportDoc2Bib(otherdocs,outdir,\
-                bibfolder,allfolders,isfile,iszotero,verbose)
+                bibfolder,allfolders,isfile,iszotero,verbose,outfiles)
             bibfaillist.extend(flist)
 
     #----------Export meta and anno to ris file----------
@@ -1101,13 +1687,13 @@ def processFolder(db,outdir,annotations,folderid,foldername,allfolders,action,\
             # <bibfolder> is the folder to save .bib file, which is <outdir> if <allfolders> is True,
             # or <outdir>/<folder_tree> otherwise.
             flist=export2ris.exportAnno2Ris(annotations,outdir,\
-                risfolder,allfolders,isfile,iszotero,verbose)
+                risfolder,allfolders,isfile,iszotero,verbose,outfiles)
             risfaillist.extend(flist)
 
         #------Export other docs without annotations------
         if len(otherdocs)>0:
             flist=export2ris.exportDoc2Ris(otherdocs,outdir,\
-                risfolder,allfolders,isfile,iszotero,verbose)
+                risfolder,allfolders,isfile,iszotero,verbose,outfiles)
             risfaillist.extend(flist)
 
 
@@ -1115,7 +1701,8 @@ def processFolder(db,outdir,annotations,folderid,foldername,allfolders,action,\
 
     
 def processCanonicals(db,outdir,annotations,docids,allfolders,action,\
-        separate,iszotero,verbose):
+        separate,iszotero,verbose,jobs=1,manifest=None,copier=None,\
+        cache=None,engine='layout',outfiles=None,tables=None,pool=None):
     '''Process files/docs in a folder.
 
     <db>: sqlite database.
@@ -1127,6 +1714,20 @@ def processCanonicals(db,outdir,annotations,docids,allfolders,action,\
     <action>: list, possible elements: m, n, e, b.
     <separate>: bool, whether save one output for each file or all files.
     <iszotero>: bool, whether exported .bib is reformated to cater to zotero import or not.
+    <jobs>: int, number of worker processes to export PDFs and extract
+            annotations with.
+    <manifest>: ExportManifest obj or None. If given, skip exporting PDFs
+                unchanged since the last run.
+    <copier>: PdfCopier obj or None, to copy un-annotated PDFs with.
+    <cache>: AnnoCache obj or None, cache of highlighted texts.
+    <engine>: str, 'layout' or 'chars', how chars are grouped into text
+              boxes in highlight extraction.
+    <outfiles>: OutputFiles obj or None, buffered writers of output text,
+                .bib and .ris files, kept open for the whole run.
+    <tables>: TableFiles obj or None. If given, highlights and notes are
+              also exported to a data table, one row each.
+    <pool>: multiprocessing.Pool obj or None, worker processes of the run,
+            used if <jobs> > 1.
     '''
     
     exportfaillist=[]
@@ -1142,12 +1743,14 @@ def processCanonicals(db,outdir,annotations,docids,allfolders,action,\
         isnote=True
 
     #------------Get raw annotation data------------
-    for ii,idii in enumerate(docids):
-        if ishighlight:
-            annotations=getHighlights(db,annotations,folderid=None,foldername=None,filterdocid=idii)
-        if isnote:
-            annotations=getNotes(db,annotations,folderid=None,foldername=None,filterdocid=idii)
-            annotations=getDocNotes(db,annotations,folderid=None,foldername=None,filterdocid=idii)
+    if ishighlight:
+        annotations=getHighlights(db,annotations,folderid=None,foldername=None,\
+                filterdocids=docids)
+    if isnote:
+        annotations=getNotes(db,annotations,folderid=None,foldername=None,\
+                filterdocids=docids)
+        annotations=getDocNotes(db,annotations,folderid=None,foldername=None,\
+                filterdocids=docids)
 
     if len(annotations)==0:
         print('\n# <Menotexport>: No annotations found among Canonical docs.')
@@ -1171,21 +1774,23 @@ def processCanonicals(db,outdir,annotations,docids,allfolders,action,\
             if verbose:
                 printHeader('Exporting annotated PDFs ...',2)
             flist=exportpdf.exportAnnoPdf(annotations,\
-                    outdir_folder,verbose)
+                    outdir_folder,verbose,jobs,manifest,pool)
             exportfaillist.extend(flist)
     
         #--------Copy other PDFs to target location--------
         if len(otherdocs)>0:
             if verbose:
                 printHeader('Exporting un-annotated PDFs ...',2)
-            flist=exportpdf.copyPdf(otherdocs,outdir_folder,verbose)
+            flist=exportpdf.copyPdf(otherdocs,outdir_folder,verbose,\
+                    manifest,copier)
             exportfaillist.extend(flist)
 
     #----------Extract annotations from PDFs----------
     if len(annotations)>0:
         if verbose:
             printHeader('Extracting annotations from PDFs ...',2)
-        annotations,flist=extractAnnos(annotations,action,verbose)
+        annotations,flist=extractAnnos(annotations,action,verbose,jobs,\
+                cache,engine,pool)
         annofaillist.extend(flist)
 
     #------------Export annotations to txt------------
@@ -1193,12 +1798,22 @@ def processCanonicals(db,outdir,annotations,docids,allfolders,action,\
         if verbose:
             printHeader('Exporting annotations to text file...',2)
         flist=exportannotation.exportAnno(annotations,outdir_folder,action,\
-                separate,verbose)
+                separate,verbose,outfiles)
         annofaillist.extend(flist)
 
         #--------Export annotations grouped by tags--------
         tagsdict=extracttags.groupByTags(annotations)
-        extracttags.exportAnno(tagsdict,outdir_folder,action,verbose)
+        extracttags.exportAnno(tagsdict,outdir_folder,action,verbose,\
+                outfiles)
+
+    #----------Export annotations to a data table----------
+    if tables is not None and ('m' in action or 'n' in action) and\
+            len(annotations)>0:
+        if verbose:
+            printHeader('Exporting annotations to %s table...' %tables.fmt,2)
+        tablefolder=outdir if allfolders else outdir_folder
+        export2table.exportAnno2Table(annotations,tablefolder,\
+                allfolders,tables,verbose)
 
     #----------Export meta and anno to bib file----------
     if 'b' in action:
@@ -1215,13 +1830,13 @@ def processCanonicals(db,outdir,annotations,docids,allfolders,action,\
             # <bibfolder> is the folder to save .bib file, which is <outdir> if <allfolders> is True,
             # or <outdir>/<folder_tree> otherwise.
             flist=export2bib.exportAnno2Bib(annotations,outdir,\
-                bibfolder,allfolders,isfile,iszotero,verbose)
+                bibfolder,allfolders,isfile,iszotero,verbose,outfiles)
             bibfaillist.extend(flist)
 
         #------Export other docs without annotations------
         if len(otherdocs)>0:
             flist=export2bib.exportDoc2Bib(otherdocs,outdir,\
-                bibfolder,allfolders,isfile,iszotero,verbose)
+                bibfolder,allfolders,isfile,iszotero,verbose,outfiles)
             bibfaillist.extend(flist)
 
     #----------Export meta and anno to ris file----------
@@ -1239,13 +1854,13 @@ def processCanonicals(db,outdir,annotations,docids,allfolders,action,\
             # <bibfolder> is the folder to save .bib file, which is <outdir> if <allfolders> is True,
             # or <outdir>/<folder_tree> otherwise.
             flist=export2ris.exportAnno2Ris(annotations,outdir,\
-                risfolder,allfolders,isfile,iszotero,verbose)
+                risfolder,allfolders,isfile,iszotero,verbose,outfiles)
             risfaillist.extend(flist)
 
         #------Export other docs without annotations------
         if len(otherdocs)>0:
             flist=export2ris.exportDoc2Ris(otherdocs,outdir,\
-                risfolder,allfolders,isfile,iszotero,verbose)
+                risfolder,allfolders,isfile,iszotero,verbose,outfiles)
             risfaillist.extend(flist)
 
 
@@ -1254,10 +1869,12 @@ def processCanonicals(db,outdir,annotations,docids,allfolders,action,\
 
 
 #----------------Bulk export to pdf----------------
-def main(dbfin,outdir,action,folder,separate,iszotero,verbose=True):
+def main(dbfin,outdir,action,folder,separate,iszotero,verbose=True,jobs=1,\
+        incremental=False,link=None,cache='on',engine='layout',table=None,\
+        immutable=False):
     
     try:
-        db = sqlite3.connect(dbfin)
+        db=connectDb(dbfin,immutable)
         if verbose:
             printHeader('Connected to database:')
             printInd(dbfin,2)
@@ -1266,61 +1883,157 @@ def main(dbfin,outdir,action,folder,separate,iszotero,verbose=True):
         printInd(dbfin)
         return 1
 
-    #----------------Get folder list----------------
-    folderlist=getFolderList(db,folder)
-    allfolders=True if folder is None else False
+    # Writers and workers are dropped if processing fails, leaving no
+    # partial outputs or temp files. The cache and db are always closed.
+    hlcache=None
+    outfiles=None
+    tables=None
+    pool=None
 
-    #---------------Get canonical doc ids--------------
-    if folder is None:
-        canonical_doc_ids=getCanonicals(db)
+    try:
+        #----------------Get folder list----------------
+        folderlist=getFolderList(db,folder)
+        allfolders=True if folder is None else False
+
+        #---------------Get canonical doc ids--------------
+        if folder is None:
+            canonical_doc_ids=getCanonicals(db)
+
+        if len(folderlist)==0 and len(canonical_doc_ids)==0:
+            printHeader('It looks like no docs are found in the library. Quit.')
+            return 1
+
+        #-----------Manifest of PDFs exported last time-----------
+        if incremental and 'p' in action:
+            manifest=exportmanifest.ExportManifest(outdir,\
+                    getDbCache(db,PathResolver).getHash)
+        else:
+            manifest=None
 
-    if len(folderlist)==0 and len(canonical_doc_ids)==0:
-        printHeader('It looks like no docs are found in the library. Quit.')
-        return 1
+        #-------------Copy un-annotated PDFs, or link-------------
+        if 'p' in action:
+            copier=exportpdf.PdfCopier(link)
+        else:
+            copier=None
 
-    #---------------Process--------------------------
-    exportfaillist=[]
-    annofaillist=[]
-    bibfaillist=[]
-    risfaillist=[]
+        #-------------Cache of highlighted texts-------------
+        if cache!='off' and 'm' in action:
+            try:
+                hlcache=annocache.AnnoCache(gethash=getDbCache(db,PathResolver).getHash)
+                if cache=='rebuild':
+                    hlcache.clear()
+            except:
+                printHeader('Failed to open cache of highlights. Continue without cache.')
+                hlcache=None
+
+        #-------------Writers of text, .bib and .ris files-------------
+        outfiles=outputfiles.OutputFiles()
 
-    #---------------Loop through folders---------------
-    if len(folderlist)>0:
-        for ii,folderii in enumerate(folderlist):
-            fidii,fnameii=folderii
+        #-------------Writers of data tables-------------
+        if table is not None:
+            try:
+                tables=export2table.TableFiles(table,outfiles)
+                if tables.cls is not export2table.JsonlWriter:
+                    export2table.importArrow()
+            except Exception as e:
+                printHeader('Failed to export to %s table: %s' %(table,e))
+                return 1
+
+        #-----------Worker processes shared by all folders-----------
+        if jobs>1 and ('p' in action or 'm' in action or 'n' in action):
+            pool=newPool(jobs)
+
+        #---------------Process--------------------------
+        exportfaillist=[]
+        annofaillist=[]
+        bibfaillist=[]
+        risfaillist=[]
+
+        #---------------Loop through folders---------------
+        if len(folderlist)>0:
+
+            stats=getDbCache(db,FolderStats)
             if verbose:
-                printNumHeader('Processing folder: "%s"' %fnameii,\
-                        ii+1,len(folderlist),1)
+                counts=[stats.getCounts(ff[0]) for ff in folderlist]
+                printHeader('Found in %d folders: %d docs, %d highlights, %d notes'\
+                        %tuple([len(folderlist),]+[sum(ii) for ii in zip(*counts)]))
+
+            # Query annotations of all folders at once if more than 1 to process
+            if len(folderlist)>1 and ('m' in action or 'n' in action or 'p' in action):
+                annorows=getDbCache(db,FolderAnnoRows)
+            else:
+                annorows=None
+
+            for ii,folderii in enumerate(folderlist):
+                fidii,fnameii=folderii
+                if verbose:
+                    printNumHeader('Processing folder: "%s"' %fnameii,\
+                            ii+1,len(folderlist),1)
+                    printInd('%d docs, %d highlights, %d notes'\
+                            %stats.getCounts(fidii),2)
+
+                #-----------Skip folders with nothing to export-----------
+                if not stats.hasWork(fidii,action):
+                    printHeader('No annotations found in folder: %s' %fnameii,2)
+                    continue
+
+                annotations={}
+                exportfaillistii,annofaillistii,bibfaillistii,risfaillistii=\
+                        processFolder(db,outdir,annotations,\
+                    fidii,fnameii,allfolders,action,separate,iszotero,verbose,\
+                    annorows,jobs,manifest,copier,hlcache,engine,outfiles,tables,\
+                    pool)
+
+                exportfaillist.extend(exportfaillistii)
+                annofaillist.extend(annofaillistii)
+                bibfaillist.extend(bibfaillistii)
+                risfaillist.extend(risfaillistii)
+
+        #---------------Process canonical docs ------------
+        if folder is None and len(canonical_doc_ids)>0:
+            if verbose:
+                printHeader('Processing docs under "My Library"')
             annotations={}
             exportfaillistii,annofaillistii,bibfaillistii,risfaillistii=\
-                    processFolder(db,outdir,annotations,\
-                fidii,fnameii,allfolders,action,separate,iszotero,verbose)
+                    processCanonicals(db,outdir,annotations,\
+                    canonical_doc_ids,allfolders,action,separate,iszotero,verbose,\
+                    jobs,manifest,copier,hlcache,engine,outfiles,tables,pool)
 
             exportfaillist.extend(exportfaillistii)
             annofaillist.extend(annofaillistii)
             bibfaillist.extend(bibfaillistii)
             risfaillist.extend(risfaillistii)
 
-    #---------------Process canonical docs ------------
-    if folder is None and len(canonical_doc_ids)>0:
-        if verbose:
-            printHeader('Processing docs under "My Library"')
-        annotations={}
-        exportfaillistii,annofaillistii,bibfaillistii,risfaillistii=\
-                processCanonicals(db,outdir,annotations,\
-                canonical_doc_ids,allfolders,action,separate,iszotero,verbose)
-
-        exportfaillist.extend(exportfaillistii)
-        annofaillist.extend(annofaillistii)
-        bibfaillist.extend(bibfaillistii)
-        risfaillist.extend(risfaillistii)
+            printHeader('NOTE that docs not belonging to any folder is saved to directory : "Canonical-My Library"')
 
-        printHeader('NOTE that docs not belonging to any folder is saved to directory : "Canonical-My Library"')
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if tables is not None:
+            tables.close()
+        outfiles.close()
+        if manifest is not None:
+            manifest.save()
 
-    #-----------------Close connection-----------------
-    if verbose:
-        printHeader('Drop connection to database:')
-    db.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if tables is not None:
+            tables.abort()
+        if outfiles is not None:
+            outfiles.abort()
+        raise
+
+    finally:
+        if hlcache is not None:
+            hlcache.close()
+
+        #-----------------Close connection-----------------
+        if verbose:
+            printHeader('Drop connection to database:')
+        clearDbCache(db)
+        db.close()
 
     #------------------Print summary------------------
     exportfaillist=list(set(exportfaillist))
@@ -1329,6 +2042,9 @@ def main(dbfin,outdir,action,folder,separate,iszotero,verbose=True):
     risfaillist=list(set(risfaillist))
 
     printHeader('Summary',1)
+    if copier is not None and len(copier.counts)>0:
+        printHeader(copier.summary(),2)
+
     if len(exportfaillist)>0:
         printHeader('Failed to export PDFs:',2)
         for failii in exportfaillist:
@@ -1354,11 +2070,6 @@ def main(dbfin,outdir,action,folder,separate,iszotero,verbose=True):
         if verbose:
             printHeader('All done.',2)
 
-    #-----------------Remove tmp file-----------------
-    if os.path.exists('tmp.txt'):
-	    os.remove('tmp.txt')
-
-
     return 0
 
 
@@ -1433,6 +2144,63 @@ if __name__ == "__main__":
             to facilitate import into Zotero.
             Only works when -b and/or -r are toggled.''')
 
+    parser.add_argument('-j', '--jobs', dest='jobs',\
+            type=int, default=1, help='''Number of processes to extract
+            highlights and notes, and to export annotated PDFs with.
+            Default to 1.''')
+
+    parser.add_argument('-i', '--incremental', action='store_true',\
+            default=False,\
+            help='''Skip exporting PDFs whose file, highlights and notes
+            are unchanged since the last export to <outdir>.
+            Only works when -p is toggled.''')
+
+    parser.add_argument('-l', '--link', dest='link',\
+            type=str, default=None, choices=exportpdf.PdfCopier.modes,\
+            help='''Export un-annotated PDFs as hard links or
+            copy-on-write clones (reflinks) of the Mendeley files,
+            instead of copies. Fall back to copies if the link can't
+            be made, e.g. when <outdir> is on a different filesystem.
+            NOTE that hard links share contents with the Mendeley files.
+            Only works when -p is toggled.''')
+
+    parser.add_argument('--no-cache', dest='cache', action='store_const',\
+            const='off', default='on',\
+            help='''Don't use the cache of extracted highlights.
+            By default, texts extracted from a page are cached in the
+            user cache directory, and re-used as long as the PDF and
+            the highlights in that page are unchanged.''')
+    parser.add_argument('--rebuild-cache', dest='cache', action='store_const',\
+            const='rebuild',\
+            help='''Empty the cache of extracted highlights before
+            processing.''')
+
+    parser.add_argument('--engine', dest='engine',\
+            type=str, default='layout', choices=['layout','chars'],\
+            help='''How to find the texts of highlights. "layout" (default)
+            groups all chars in a page into text boxes by the full
+            layout analysis of pdfminer. "chars" skips that analysis,
+            and only groups chars close to the highlights into lines
+            and boxes. Much faster on long or dense pages, but may
+            order texts differently in complex layouts.''')
+
+    parser.add_argument('--table', dest='table',\
+            type=str, default=None, choices=sorted(export2table.WRITERS),\
+            help='''Also export highlights and notes to a data table, one
+            row each, with the document id, citation key, page, rect,
+            color, creation time, text and tags. "jsonl" writes a
+            JSON Lines file, "parquet" and "arrow" write columnar
+            Parquet or Arrow IPC files, and require pyarrow. Can be used
+            with -m and -n.''')
+
+    parser.add_argument('--immutable', action='store_true',\
+            default=False,\
+            help='''Open the database as immutable, taking no locks at all.
+            Faster, but only safe if Mendeley Desktop is closed, or not
+            changing the library during the export. By default the
+            database is opened read-only, and reads only take shared
+            locks.''')
+
     parser.add_argument('-v', '--verbose', action='store_true',\
             default=True,\
             help='Print some texts.')
@@ -1447,7 +2215,9 @@ if __name__ == "__main__":
     outdir = os.path.abspath(args.outdir)
 
     main(dbfile,outdir,args.action,args.folder,\
-            args.separate,args.zotero,args.verbose)
+            args.separate,args.zotero,args.verbose,args.jobs,\
+            args.incremental,args.link,args.cache,args.engine,args.table,\
+            args.immutable)
 
 
 